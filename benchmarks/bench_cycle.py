@@ -0,0 +1,151 @@
+"""Benchmark of full bot cycles against FakeTelegramClient
+
+Usage: python benchmarks/bench_cycle.py --channels 10 100 1000 [--history-rows 1000000]
+Every channel count is measured in its own process, so peak RSS is not shared between runs.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from hashlib import sha256
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'client'))
+
+# pylint: disable=wrong-import-position
+import app  # noqa: E402  # pylint: disable=unused-import
+from app import App  # noqa: E402
+from bot import Bot, BotSettings  # noqa: E402
+from content_filter import ContentFilter  # noqa: E402
+from database.database import Database, chunked  # noqa: E402
+from database.database_mappings import Channel as ChannelMapping  # noqa: E402
+from database.database_mappings import Message as MessageMapping  # noqa: E402
+from database.database_mappings import Outbox as OutboxMapping  # noqa: E402
+from destination import DedupState, Destination  # noqa: E402
+from fake_client import FakeSettings, FakeTelegramClient  # noqa: E402
+from file_processor import FileProcessor  # noqa: E402
+from metrics import MESSAGES  # noqa: E402
+from outbox import Outbox, OutboxSettings  # noqa: E402
+from routing import Route  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+
+HISTORY_CHANNEL_ID = 1
+
+
+def seed_history(database: Database, rows: int, seed: int) -> None:
+    """Fill messages table with rows of old history"""
+    rnd = random.Random(seed)
+    with database.get_session() as session, session.begin():
+        database.upsert(session, ChannelMapping,
+                        [{'id': HISTORY_CHANNEL_ID, 'username': 'history'}], ['id'])
+        for chunk in chunked(range(rows), 50_000):
+            database.bulk_insert(session, MessageMapping, [
+                {'msg_id': msg_id, 'group_id': None, 'channel_id': HISTORY_CHANNEL_ID,
+                 'hash': sha256(msg_id.to_bytes(8, 'little')).digest(),
+                 'phash': rnd.getrandbits(63)} for msg_id in chunk])
+
+
+async def drain_outbox(outbox: Outbox, client: FakeTelegramClient, posts: int) -> float:
+    """Run sender until posts are sent, return seconds spent"""
+    start = time.perf_counter()
+    sender = asyncio.create_task(outbox.run('main'))
+    outbox.wake()
+    while len(client.sent) < posts and not sender.done():
+        await asyncio.sleep(0.01)
+    sender.cancel()
+    return time.perf_counter() - start
+
+
+async def run(args: argparse.Namespace, channels: int) -> None:
+    """Measure cycles for channels count"""
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    owner = App('0', '', work_dir)
+    database = Database(owner.database_path)
+    start = time.perf_counter()
+    seed_history(database, args.history_rows, args.seed)
+    seed_time = time.perf_counter() - start
+
+    client = FakeTelegramClient(channels, FakeSettings(
+        history=args.history, latency=args.latency, flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds, seed=args.seed))
+    channel_file = os.path.join(work_dir, 'channels.txt')
+    with open(channel_file, 'w', encoding='utf-8') as out:
+        out.write('\n'.join(client.usernames_list()) + '\n')
+    outbox = Outbox(client, database, OutboxSettings(posts_per_minute=60 * 10 ** 6, burst=1000))
+    # every cycle polls all channels, regardless of their post rate
+    settings = BotSettings(fetch_concurrency=args.fetch_concurrency, min_poll_interval=0,
+                           max_poll_interval=0)
+    destination = Destination(Route('', 'main'), DedupState(settings.dedup), outbox, ContentFilter())
+    bot = Bot(owner, client, database, FileProcessor(channel_file), [destination], settings)
+    start = time.perf_counter()
+    await bot.setup()
+    setup_time = time.perf_counter() - start
+
+    cycle_times = []
+    fetched = MESSAGES.value(outcome='fetched')
+    for cycle in range(args.cycles):
+        if cycle:
+            client.post(args.new_per_cycle)
+        start = time.perf_counter()
+        await bot._cycle()  # pylint: disable=protected-access
+        cycle_times.append(time.perf_counter() - start)
+    fetched = MESSAGES.value(outcome='fetched') - fetched
+
+    with database.get_session() as session:
+        posts = database.execute(session, database.select(func.count(OutboxMapping.id))) \
+                        .scalar_one()
+    send_time = await drain_outbox(outbox, client, posts)
+
+    total = sum(cycle_times)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    db_size = sum(os.path.getsize(f'{owner.database_path}{suffix}')
+                  for suffix in ('', '-wal') if os.path.exists(f'{owner.database_path}{suffix}'))
+    print(f'channels: {channels:>6} | history rows: {args.history_rows:>8} '
+          f'(seed {seed_time:.1f}s, setup {setup_time:.2f}s) | '
+          f'cycles: {", ".join(f"{t:.2f}s" for t in cycle_times)} | '
+          f'{fetched / total:,.0f} msg/s | requests: {client.requests}, '
+          f'flood waits: {client.flood_waits}, downloads: {client.downloads} | '
+          f'posted {len(client.sent)} in {send_time:.2f}s | '
+          f'peak rss: {rss:.0f} MiB | db: {db_size / 2 ** 20:.1f} MiB', flush=True)
+
+
+def main() -> None:
+    """benchmark entrypoint"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--history', type=int, default=200,
+                        help='Messages in every channel before the first cycle')
+    parser.add_argument('--new-per-cycle', type=int, default=20,
+                        help='Messages posted to every channel between cycles')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--history-rows', type=int, default=0,
+                        help='Rows of old history put to database before the run')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds per request')
+    parser.add_argument('--flood-rate', type=float, default=0.,
+                        help='Probability of flood wait per request')
+    parser.add_argument('--flood-seconds', type=int, default=1,
+                        help='Flood wait duration, waits over 60s are raised as FloodWaitError')
+    parser.add_argument('--fetch-concurrency', type=int, default=BotSettings.fetch_concurrency)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(args.channels) > 1:
+        for channels in args.channels:
+            argv = [f'--{name.replace("_", "-")}={value}' for name, value in vars(args).items()
+                    if name != 'channels']
+            subprocess.run([sys.executable, __file__, '--channels', str(channels)] + argv,
+                           check=True)
+        return
+    asyncio.run(run(args, args.channels[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Microbenchmark of perceptual hash near-duplicates lookup
+
+Usage: python benchmarks/bench_phash.py [--size 1000000] [--threshold 4] [--queries 10000]
+"""
+
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+# pylint: disable=wrong-import-position
+from phash import HASH_BITS, PHashIndex  # noqa: E402
+
+
+def flip_bits(value: int, count: int, rnd: random.Random) -> int:
+    """Make near duplicate of value"""
+    for bit in rnd.sample(range(HASH_BITS), count):
+        value ^= 1 << bit
+    return value
+
+
+def main() -> None:
+    """benchmark entrypoint"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1_000_000, help='Stored hashes count')
+    parser.add_argument('--threshold', type=int, default=4, help='Max hamming distance')
+    parser.add_argument('--queries', type=int, default=10_000, help='Lookups to measure')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    stored = [rnd.getrandbits(HASH_BITS) for _ in range(args.size)]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    index = PHashIndex(args.threshold)
+    for value in stored:
+        index.add(value)
+    build = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'build: {args.size} hashes in {build:.2f}s, '
+          f'peak rss growth: {(rss_after - rss_before) / 1024:.1f} MiB')
+
+    misses = [rnd.getrandbits(HASH_BITS) for _ in range(args.queries)]
+    hits = [flip_bits(rnd.choice(stored), rnd.randint(0, args.threshold), rnd)
+            for _ in range(args.queries)]
+    for name, queries in (('miss', misses), ('near duplicate', hits)):
+        start = time.perf_counter()
+        found = sum(index.find(value) is not None for value in queries)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed / len(queries) * 1e6:.1f} us/lookup, '
+              f'found {found}/{len(queries)}')
+
+    sample = stored[:min(args.size, 100_000)]
+    query = misses[0]
+    start = time.perf_counter()
+    _ = [value for value in sample if bin(value ^ query).count('1') <= args.threshold]
+    scan = (time.perf_counter() - start) * args.size / len(sample)
+    print(f'linear scan estimate: {scan * 1e6:.1f} us/lookup')
+
+
+if __name__ == '__main__':
+    main()
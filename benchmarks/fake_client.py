@@ -0,0 +1,234 @@
+"""Offline stand-in for the TelegramClient methods used by Bot
+
+Channels, albums and reposts are generated deterministically from seed,
+network latency and flood waits are simulated, so bot cycles can be measured without network.
+"""
+
+import asyncio
+import random
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import AsyncIterator, Optional, Union
+
+from PIL import Image
+from telethon import utils
+from telethon.errors import FloodWaitError, InviteHashInvalidError
+from telethon.tl.functions.channels import JoinChannelRequest
+from telethon.tl.functions.messages import ImportChatInviteRequest
+from telethon.tl.types import (
+    Channel,
+    ChatPhotoEmpty,
+    Document,
+    DocumentAttributeVideo,
+    InputPeerChannel,
+    Message,
+    MessageEntityTextUrl,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    PeerChannel,
+    Photo,
+    PhotoSize,
+    Updates,
+    User,
+)
+
+DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+# messages returned by one GetHistoryRequest
+PAGE_SIZE = 100
+
+
+@dataclass
+class FakeSettings:
+    """Shape of generated content and network behaviour"""
+
+    # messages already in each channel before the first cycle
+    history: int = 200
+    # share of media messages which are reposts of media from shared pool
+    repost_rate: float = 0.1
+    repost_pool: int = 1000
+    # share of 4-message blocks posted as albums
+    album_rate: float = 0.2
+    # share of messages without media
+    text_rate: float = 0.2
+    # share of captions with url entity or too long to pass the filter
+    spam_rate: float = 0.1
+    # seconds per request
+    latency: float = 0.
+    # probability of flood wait per request and its duration,
+    # like real client, waits up to flood_sleep_threshold are slept through instead of raised
+    flood_rate: float = 0.
+    flood_seconds: int = 1
+    flood_sleep_threshold: int = 60
+    seed: int = 0
+
+
+class FakeTelegramClient:
+    """Implements get_me, get_input_entity, get_entity, iter_messages, get_messages,
+       iter_dialogs, send_file, download_media, add_event_handler and requests via __call__
+    """
+
+    # messages text is returned as is, see telethon Message.text
+    parse_mode = None
+
+    def __init__(self, channels: int, settings: Optional[FakeSettings] = None) -> None:
+        self.settings = settings or FakeSettings()
+        self._rnd = random.Random(self.settings.seed)
+        self.channels: dict[int, Channel] = {}
+        self.usernames: dict[str, int] = {}
+        for i in range(channels + 1):
+            # channel 0 is the main one
+            username = 'main' if i == 0 else f'channel{i}'
+            entt = Channel(id=1000 + i, title=username.title(), photo=ChatPhotoEmpty(),
+                           date=DATE, access_hash=i * 7919, username=username, broadcast=True)
+            self.channels[entt.id] = entt
+            self.usernames[username] = entt.id
+        self.last_msg_id = {ch_id: self.settings.history for ch_id in self.channels}
+        self.requests = 0
+        self.flood_waits = 0
+        self.downloads = 0
+        self.sent: list[tuple[int, int, str]] = []
+        # ids of channels the account is a member of
+        self.joined: set[int] = set()
+
+    def usernames_list(self) -> list[str]:
+        """Source channels usernames, e.g. to write channel file"""
+        return [username for username in self.usernames if username != 'main']
+
+    def post(self, count: int) -> None:
+        """Add count new messages to every channel"""
+        for ch_id in self.last_msg_id:
+            self.last_msg_id[ch_id] += count
+
+    async def _request(self) -> None:
+        self.requests += 1
+        if self.settings.latency:
+            await asyncio.sleep(self.settings.latency)
+        if self.settings.flood_rate and self._rnd.random() < self.settings.flood_rate:
+            self.flood_waits += 1
+            if self.settings.flood_seconds > self.settings.flood_sleep_threshold:
+                raise FloodWaitError(None, capture=self.settings.flood_seconds)
+            await asyncio.sleep(self.settings.flood_seconds)
+
+    async def get_me(self) -> User:
+        """Current user"""
+        await self._request()
+        return User(id=1, is_self=True, first_name='bench')
+
+    async def get_input_entity(self, peer: Union[str, Channel, InputPeerChannel, PeerChannel]) \
+        -> InputPeerChannel:
+        """Resolve username or peer, they are cached by telethon session, so no request here"""
+        if isinstance(peer, str):
+            ch_id = self.usernames.get(peer.lower().lstrip('@'))
+            if ch_id is None:
+                raise ValueError(f'No user has "{peer}" as username')
+            peer = self.channels[ch_id]
+        elif isinstance(peer, PeerChannel):
+            peer = self.channels[peer.channel_id]
+        return utils.get_input_peer(peer)
+
+    async def get_entity(self, peer: Union[str, Channel, InputPeerChannel]) -> Channel:
+        """Full channel info"""
+        input_peer = await self.get_input_entity(peer)
+        await self._request()
+        return self.channels[input_peer.channel_id]
+
+    async def __call__(self, request):
+        await self._request()
+        if isinstance(request, JoinChannelRequest):
+            self.joined.add(request.channel.id)
+            return Updates(updates=[], users=[], chats=[], date=DATE, seq=0)
+        if isinstance(request, ImportChatInviteRequest):
+            raise InviteHashInvalidError(request)
+        raise NotImplementedError(type(request).__name__)
+
+    async def iter_dialogs(self) -> AsyncIterator[SimpleNamespace]:
+        """Joined channels, as telethon Dialog objects"""
+        await self._request()
+        for ch_id in self.joined:
+            yield SimpleNamespace(entity=self.channels[ch_id], is_channel=True)
+
+    def add_event_handler(self, callback, event=None) -> None:
+        """Live updates are not generated"""
+
+    async def send_file(self, entity, file, caption: str = '') -> None:
+        """Pretend to upload media"""
+        await self._request()
+        media = file if isinstance(file, list) else [file]
+        self.sent.append((utils.get_peer_id(entity), len(media), caption))
+
+    async def download_media(self, message, file: str, *, thumb: Optional[int] = None) \
+        -> Optional[str]:
+        """Write picture generated from photo id, reposts get the same picture.
+           Videos have no thumbnails.
+        """
+        media = getattr(message, 'media', message)
+        if not isinstance(media, MessageMediaPhoto) and thumb is not None:
+            return None
+        await self._request()
+        self.downloads += 1
+        if isinstance(media, MessageMediaDocument):
+            with open(file, 'wb') as out:
+                out.write(media.document.id.to_bytes(8, 'little') * 1024)
+            return file
+        rnd = random.Random(f'{self.settings.seed}-photo-{media.photo.id}')
+        image = Image.new('L', (9, 8))
+        image.putdata([rnd.randrange(256) for _ in range(72)])
+        image.resize((90, 80) if thumb is not None else (800, 600)).save(file, 'JPEG')
+        return file
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, min_id: int = 0,
+                            reverse: bool = False) -> AsyncIterator[Message]:
+        """Messages newer than min_id, newest first unless reverse, fetched by pages"""
+        ch_id = (await self.get_input_entity(entity)).channel_id
+        last = self.last_msg_id[ch_id]
+        ids = range(min_id + 1, last + 1) if reverse else range(last, min_id, -1)
+        if limit is not None:
+            ids = ids[:limit]
+        for page_start in range(0, len(ids), PAGE_SIZE):
+            await self._request()
+            for msg_id in ids[page_start:page_start + PAGE_SIZE]:
+                yield self._message(ch_id, msg_id)
+
+    async def get_messages(self, entity, ids: list[int]) -> list[Optional[Message]]:
+        """Messages by ids, None for ones not posted yet"""
+        ch_id = (await self.get_input_entity(entity)).channel_id
+        await self._request()
+        return [self._message(ch_id, msg_id) if 0 < msg_id <= self.last_msg_id[ch_id] else None
+                for msg_id in ids]
+
+    def _message(self, ch_id: int, msg_id: int) -> Message:
+        """Generate the same message for the same channel and id every time"""
+        rnd = random.Random(f'{self.settings.seed}-{ch_id}-{msg_id}')
+        block = random.Random(f'{self.settings.seed}-{ch_id}-block-{msg_id // 4}')
+        grouped_id = ch_id * 10 ** 9 + msg_id // 4 \
+            if block.random() < self.settings.album_rate else None
+        text = f'post {msg_id}'
+        entities = []
+        if rnd.random() < self.settings.spam_rate:
+            text = 'subscribe to our partners channel'
+            entities.append(MessageEntityTextUrl(0, 9, 'https://t.me/partner'))
+        media = None
+        if grouped_id is not None or rnd.random() >= self.settings.text_rate:
+            if rnd.random() < self.settings.repost_rate:
+                file_id = rnd.randrange(self.settings.repost_pool)
+            else:
+                file_id = ch_id * 10 ** 9 + msg_id + self.settings.repost_pool
+            media = self._media(file_id, rnd.random() < 0.25)
+        msg = Message(id=msg_id, peer_id=PeerChannel(ch_id), date=DATE, message=text,
+                      media=media, grouped_id=grouped_id, entities=entities)
+        # pylint: disable=protected-access
+        msg._client = self
+        return msg
+
+    @staticmethod
+    def _media(file_id: int, video: bool) -> Union[MessageMediaPhoto, MessageMediaDocument]:
+        file_reference = file_id.to_bytes(8, 'little')
+        if video:
+            return MessageMediaDocument(document=Document(
+                id=file_id, access_hash=file_id, file_reference=file_reference, date=DATE,
+                mime_type='video/mp4', size=1 << 20, dc_id=2,
+                attributes=[DocumentAttributeVideo(duration=10, w=640, h=480)]))
+        return MessageMediaPhoto(photo=Photo(
+            id=file_id, access_hash=file_id, file_reference=file_reference, date=DATE,
+            sizes=[PhotoSize(type='x', w=800, h=600, size=1 << 16)], dc_id=2))
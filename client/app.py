@@ -1,28 +1,81 @@
+import asyncio
 import logging
 import os
+import signal
+from contextlib import ExitStack
+from typing import Optional
 
-from bot import Bot
-from database.database import Database
+from bot import Bot, BotSettings
+from content_filter import ContentFilter
+from database.database import Database, SqliteSettings
+from destination import DedupState, Destination
 from file_processor import FileProcessor
+from media_cache import MediaCache, MediaCacheSettings
+from metrics import MetricsExporter, instrument_engine
+from outbox import Outbox, OutboxSettings
+from profiler import CycleProfiler
+from retention import Retention, RetentionSettings
+from routing import Route
+from sharding import HashRing
 from telethon import TelegramClient
 
 
 class App:
 
-    def __init__(self, api_id: str, api_hash: str, work_dir: str) -> None:
+    def __init__(self, api_id: str, api_hash: str, work_dir: str,
+                 metrics_port: Optional[int] = None, profile_cycles: int = 0,
+                 media_cache_settings: Optional[MediaCacheSettings] = None) -> None:
         self.api_id = api_id
         self.api_hash = api_hash
         self.logger = logging.getLogger('Main.app')
         self.working_dir = work_dir
         os.makedirs(self.working_dir, exist_ok=True)
+        self.metrics_exporter = MetricsExporter(os.path.join(self.working_dir, 'metrics.prom'),
+                                                metrics_port)
+        # profile first cycles if asked, next ones are profiled on SIGUSR1
+        self.profiler = CycleProfiler(self.working_dir, max(profile_cycles, 1))
+        if profile_cycles:
+            self.profiler.request()
+        self.media_cache = MediaCache(self.download_dir, media_cache_settings)
 
-    def start(self, session_name: str, main_channel: str, channel_file: str) -> None:
-        self.logger.info('App started')
-        session = os.path.join(self.working_dir, session_name)
-        with TelegramClient(session, int(self.api_id), self.api_hash) as client:
-            client.loop.run_until_complete(
-                Bot(self, client, Database(self.database_path), FileProcessor(channel_file))
-                                            .start(main_channel))
+    def start(self, session_names: list[str], routes: list[Route], channel_file: str,
+              settings: BotSettings, db_settings: SqliteSettings,
+              outbox_settings: OutboxSettings, retention_settings: RetentionSettings) -> None:
+        """Run bot for every session, channels from channel_file are split between them.
+           Bots share database and dedup state, the first session posts to all destinations.
+        """
+        self.logger.info('App started with sessions: %s', ', '.join(session_names))
+        database = Database(self.database_path, db_settings)
+        instrument_engine(database.engine)
+        ring = HashRing(session_names)
+        lock = asyncio.Lock()
+        dedups = {route.name: DedupState(settings.dedup, route.name, lock) for route in routes}
+        retention = Retention(database, list(dedups.values()), retention_settings)
+        retention.setup()
+        common_filter = ContentFilter.load(settings.filter_config)
+        with ExitStack() as stack:
+            clients = [stack.enter_context(TelegramClient(os.path.join(self.working_dir, name),
+                                                          int(self.api_id), self.api_hash))
+                       for name in session_names]
+            destinations = [
+                Destination(route, dedups[route.name],
+                            Outbox(clients[0], database, outbox_settings, self.media_cache,
+                                   route.name),
+                            ContentFilter(route.filter) if route.filter is not None
+                            else common_filter)
+                for route in routes]
+            bots = []
+            for name, client in zip(session_names, clients):
+                accept = ring.owned_by(name) if len(session_names) > 1 else None
+                bots.append(Bot(self, client, database, FileProcessor(channel_file, accept),
+                                destinations, settings, name))
+            loop = clients[0].loop
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.request)
+            loop.run_until_complete(
+                asyncio.gather(*(bot.start(run_sender=i == 0)
+                                 for i, bot in enumerate(bots)),
+                               self.metrics_exporter.serve(), retention.run(),
+                               self.media_cache.run()))
 
     @property
     def database_path(self) -> str:
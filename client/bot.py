@@ -3,27 +3,51 @@
 import asyncio
 import itertools
 import logging
+import time
+from dataclasses import dataclass, field
 from hashlib import sha256
-from typing import Iterable, Optional
+from typing import AsyncIterator, Iterable, Optional
 
 import app
 import telethon
-from database.database import Database
+from database.database import Database, chunked
 from database.database_mappings import Channel as ChannelMapping
+from database.database_mappings import ChannelState as ChannelStateMapping
+from database.database_mappings import ChannelUsername as ChannelUsernameMapping
+from database.database_mappings import DedupKey as DedupKeyMapping
 from database.database_mappings import Message as MessageMapping
+from destination import DedupSettings, DedupState, Destination
 from file_processor import FileProcessor
+from hash_filter import dedup_key
+from log_pipeline import Lazy
+from media_cache import media_key
+from metrics import (
+    CYCLE_SECONDS,
+    FLOOD_WAIT_SECONDS,
+    HASH_FILTER_RATE,
+    MESSAGES,
+    STAGE_SECONDS,
+)
+from phash import image_phash, media_phash, to_signed
+from scheduler import ChannelSchedule, PollScheduler
+from sqlalchemy import func
 from sqlalchemy.orm import Session
+from telethon import events, utils
 from telethon.errors import (
     ChannelIdInvalidError,
     ChannelPrivateError,
     ChannelsTooMuchError,
+    FloodWaitError,
     InviteRequestSentError,
+    RPCError,
 )
 from telethon.tl.custom.message import Message
 from telethon.tl.functions.channels import JoinChannelRequest
 from telethon.tl.functions.messages import ImportChatInviteRequest
 from telethon.tl.types import (
-    MessageEntityTextUrl,
+    Channel,
+    ChatPhotoEmpty,
+    MessageMediaDocument,
     MessageMediaPhoto,
     TypeChat,
     TypeMessageMedia,
@@ -31,16 +55,64 @@ from telethon.tl.types import (
 )
 
 
+@dataclass
+class BotSettings:
+    """Tunables for the bot main loop"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    # how many channels may be fetched at the same time
+    fetch_concurrency: int = 8
+    # seconds to wait for the next message of a channel before giving up on it until the next cycle
+    fetch_timeout: float = 120
+    # how many times to retry channel fetch after FloodWaitError
+    flood_retries: int = 3
+    # longest flood wait to sleep during channel fetch, longer ones skip channel until next cycle
+    max_flood_wait: float = 5 * 60
+    # how many message groups single channel fetch may get ahead of processing
+    fetch_buffer: int = 100
+    # how many message groups are deduplicated and saved at once
+    batch_size: int = 100
+    # seconds between polls of channels with unknown post rate, also the longest sleep.
+    # With live updates polling only catches up missed messages
+    poll_interval: float = 5 * 60
+    # seconds between checks of channel file mtime, its changes start polling cycle early
+    channel_file_check_interval: float = 5
+    # bounds of per-channel poll interval, which is adapted to channel post rate
+    min_poll_interval: float = 60
+    max_poll_interval: float = 6 * 60 * 60
+    # random share of poll interval added or subtracted, so polls do not come in bursts
+    poll_jitter: float = 0.1
+    # seconds after which old polls weigh e times less in channel post rate
+    post_rate_window: float = 6 * 60 * 60
+    # receive new messages via telegram updates instead of waiting for the next polling cycle
+    live_updates: bool = False
+    # download smallest thumbnail to hash media which has no inlined one
+    download_thumbs: bool = True
+    # seconds to trust cached channel entities before resolving them again
+    entity_ttl: float = 24 * 60 * 60
+    # seconds before channels which failed to resolve are tried again,
+    # they are also tried once channel file changes
+    resolve_retry_interval: float = 60 * 60
+    # json file with content filter rules, see content_filter module
+    filter_config: Optional[str] = None
+    # duplicate detection shared by all destinations
+    dedup: DedupSettings = field(default_factory=DedupSettings)
+
+
 class ChannelUpd:
     """Channel model for use with telethon objects"""
 
     # pylint: disable=invalid-name
     # pylint: disable=too-few-public-methods
 
+    __slots__ = ('id', 'username', 'latest_saved_msg_id', 'entt')
+
     def __init__(self, _id: int, username: str, latest_saved_msg_id: int,
                  entt: Optional[TypeChat] = None) -> None:
         self.id = _id
         self.username = username
+        # polling cursor, messages up to it are saved
         self.latest_saved_msg_id = latest_saved_msg_id
         self.entt = entt
 
@@ -54,19 +126,29 @@ class MessageUpd:
 
     # pylint: disable=too-many-arguments
     # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-instance-attributes
+
+    # thousands of these may be alive during catch-up, so do not keep per-instance __dict__
+    __slots__ = ('msg_id', 'group_id', 'channel_id', 'text', 'media', 'entities', 'sha256',
+                 'phash')
 
     def __init__(self, msg_id: int, msg_gruop_id: Optional[int], channel_id: int,
-                 text: Optional[str], media: Optional[TypeMessageMedia], is_url: bool):
+                 text: Optional[str], media: Optional[TypeMessageMedia],
+                 entities: tuple[str, ...] = ()):
         self.msg_id = msg_id
         self.group_id = msg_gruop_id
         self.channel_id = channel_id
         self.text = text
         self.media = media
-        self.url = is_url
+        # names of text entity types, e.g. MessageEntityTextUrl
+        self.entities = entities
         try:
             self.sha256 = self._calc_hash()
         except Exception as e:
             raise ValueError from e
+        # file references differ for the same content reposted by other channels,
+        # so also keep hash of the picture itself to find such reposts
+        self.phash = media_phash(media)
 
     def _calc_hash(self) -> bytes:
         """Calculate hash for given media for future store/check if exist"""
@@ -74,8 +156,10 @@ class MessageUpd:
         # https://core.telegram.org/api/file_reference
         if isinstance(self.media, MessageMediaPhoto):
             file_ref = self.media.photo.file_reference
-        else:
+        elif isinstance(self.media, MessageMediaDocument):
             file_ref = self.media.document.file_reference
+        else:
+            raise ValueError(f'media has no file: {self.media}')
         return sha256(file_ref).digest()
 
     def __repr__(self) -> str:
@@ -86,226 +170,718 @@ class MessageUpd:
 def merge_infos(db_info: list[ChannelUpd], tg_info: list[TypeChat]) -> list[ChannelUpd]:
     """Merge info from database with new one coming from telegram"""
     new_chats = []
+    db_chats = {db_chat.id: db_chat for db_chat in db_info}
     for tg_chat in tg_info:
-        matched = False
-        for db_chat in db_info:
-            # TODO: check in usernameS maybe chat is renamed
-            if tg_chat.username == db_chat.username:
-                db_chat.entt = tg_chat
-                matched = True
-                break
+        # match by id, username might be changed since last time
+        db_chat = db_chats.get(tg_chat.id)
+        if db_chat is not None:
+            db_chat.entt = tg_chat
+            db_chat.username = tg_chat.username
+            continue
         # Not matched - 2 variants:
         # 1 - channel removed from list of content providers - old info remains in database,
         # but it doesn't exists in current tg_info
         # 2 - channel added to content provider list and doesn't have database entry yet.
         # 1st case - only get channels from db that are currently in content provider
         # (fixed outside this function), 2nd - create new channel, that will be placed to database
-        if not matched:
-            new_chats.append(ChannelUpd(tg_chat.id, tg_chat.username, 0, tg_chat))
+        new_chats.append(ChannelUpd(tg_chat.id, tg_chat.username, 0, tg_chat))
     assert all(ch.entt is not None for ch in new_chats + db_info)
     return new_chats
 
 class Bot:
     """The bot which is downloading content from channels and repost it"""
 
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+
     def __init__(self,
                  owner: 'app.App',
                  client: telethon.TelegramClient,
                  database: Database,
-                 file_processor: FileProcessor) -> None:
+                 file_processor: FileProcessor,
+                 destinations: list[Destination],
+                 settings: Optional[BotSettings] = None,
+                 account: str = '') -> None:
         self.client = client
+        # session name, entities resolved by one account can not be used by another one
+        self.account = account
+        # content is fetched and hashed once, then routed to every destination
+        self.destinations = destinations
+        self.lock = destinations[0].dedup.lock
+        self.settings = settings or BotSettings()
         self.file_processor = file_processor
         self.owner = owner
         self.logger = logging.getLogger('Main.bot')
-        self.main_channel = None
+        # trace of every fetched message, sampled by default
+        self.msg_logger = logging.getLogger('Main.bot.messages')
         # pylint: disable=invalid-name
         self.me = None
         self.db = database
+        # channels we are listening to in live updates mode, by channel id
+        self._live_channels: dict[int, ChannelUpd] = {}
+        # channel id -> ids of messages saved from live updates after polling cursor.
+        # Albums come late and live groups are saved out of order, so any id may come next
+        self._live_saved: dict[int, set[int]] = {}
+        # channel file line -> (resolved entity, when it was resolved)
+        self._entities: dict[str, tuple[TypeChat, float]] = {}
+        # channel file line -> when it failed to resolve
+        self._resolve_failed: dict[str, float] = {}
+        # time to resolve channels again after flood wait
+        self._resolve_after = 0.
+        # ids of channels the account is a member of, loaded from dialogs on first use
+        self._joined: Optional[set[int]] = None
+        # ids of channels which can not be joined, e.g. private ones
+        self._join_failed: set[int] = set()
+        # time to join channels again after flood wait
+        self._join_after = 0.
+        self.scheduler = PollScheduler(self.settings.poll_interval,
+                                       self.settings.min_poll_interval,
+                                       self.settings.max_poll_interval,
+                                       self.settings.poll_jitter,
+                                       self.settings.post_rate_window)
 
-    async def start(self, main_channel: str) -> None:
-        """Bot entrypoint"""
+    async def start(self, run_sender: bool = True) -> None:
+        """Bot entrypoint, when several bots share outboxes only one of them should run senders"""
         self.logger.info('bot started')
-        self.logger.debug('signed in as: %s', (await self.client.get_me()).stringify())
-        main_channel_input_entt = await self.client.get_input_entity(main_channel)
-        self.main_channel = await self.client.get_entity(main_channel_input_entt)
-        sleep_time = 5 * 60 # 5 min
-        await self._mainloop(sleep_time)
+        await self.setup()
+        if self.settings.live_updates:
+            self.client.add_event_handler(self._on_new_message, events.NewMessage())
+            self.client.add_event_handler(self._on_album, events.Album())
+        if run_sender:
+            await asyncio.gather(self._mainloop(self.settings.poll_interval),
+                                 *(dest.outbox.run(dest.route.channel)
+                                   for dest in self.destinations))
+        else:
+            await self._mainloop(self.settings.poll_interval)
+
+    async def setup(self) -> None:
+        """Load dedup state from database"""
+        self.logger.debug('signed in as: %s', Lazy((await self.client.get_me()).stringify))
+        async with self.lock:
+            for dest in self.destinations:
+                if not dest.dedup.ready:
+                    await self.db.run(self._warm_dedup, dest.dedup)
+                    dest.dedup.ready = True
 
-    def restore_info(self, session: Session, usernames: set[str]) -> list[ChannelUpd]:
+    def _warm_dedup(self, dedup: DedupState) -> None:
+        with self.db.get_session() as db_session:
+            dedup.warm_hash_filter(self.db, db_session)
+            dedup.warm_phash_index(self.db, db_session)
+
+    def restore_info(self, session: Session, channel_ids: set[int]) -> list[ChannelUpd]:
         """Get info saved to database from previous runs
-           We only need to get chats with usernames that are currently intresting
+           We only need to get chats with ids that are currently intresting
         """
-        # TODO: optimize query
         self.logger.info('reading database')
-        msgs = self.db.select_result(session, MessageMapping)
-        channels = self.db.execute_query(session, self.db.select(ChannelMapping)
-                                                    .filter(ChannelMapping.username.in_(usernames)))
-        info = {}
-        ch_map: ChannelMapping
-        for ch_map in channels:
-            self.logger.debug('get %s from database', ch_map)
-            info[ch_map.id] = [ch_map.username, None]
-        msg: MessageMapping
-        # TODO: if channel deleted from file: info[msg.channel_id] will raise KeyError
-        for msg in msgs:
-            self.logger.debug('get %s from database', msg)
-            if info.get(msg.channel_id) and \
-               (not info[msg.channel_id][1] or info[msg.channel_id][1] < msg.msg_id):
-                info[msg.channel_id][1] = msg.msg_id
-
-        return [ChannelUpd(ch_id, *ch_info) for ch_id, ch_info in info.items()]
+        info = []
+        for chunk in chunked(channel_ids):
+            query = self.db.select(ChannelMapping.id, ChannelMapping.username,
+                                   ChannelStateMapping.last_msg_id) \
+                           .outerjoin(ChannelStateMapping,
+                                      ChannelStateMapping.channel_id == ChannelMapping.id) \
+                           .filter(ChannelMapping.id.in_(chunk))
+            for ch_id, username, last_msg_id in self.db.execute(session, query):
+                self.logger.debug('get channel %s (@%s), last msg_id: %s from database',
+                                  ch_id, username, last_msg_id)
+                info.append(ChannelUpd(ch_id, username, last_msg_id or 0))
+        return info
+
+    def _restore_schedule(self, session: Session, channel_ids: set[int]) -> None:
+        """Add channels to scheduler with polling state saved by previous runs"""
+        unknown = [ch_id for ch_id in channel_ids if ch_id not in self.scheduler]
+        for chunk in chunked(unknown):
+            query = self.db.select(ChannelStateMapping.channel_id, ChannelStateMapping.post_rate,
+                                   ChannelStateMapping.polled_at,
+                                   ChannelStateMapping.next_poll_at) \
+                           .filter(ChannelStateMapping.channel_id.in_(chunk))
+            for ch_id, post_rate, polled_at, next_poll_at in self.db.execute(session, query):
+                self.scheduler.add(ch_id, post_rate, polled_at, next_poll_at)
+        for ch_id in unknown:
+            if ch_id not in self.scheduler:
+                self.scheduler.add(ch_id)
+
+    def _save_schedule(self, session: Session, schedules: dict[int, ChannelSchedule]) -> None:
+        """Persist polling state, so restart does not poll every channel at once"""
+        self.db.upsert(session, ChannelStateMapping,
+                       [{'channel_id': ch_id, 'last_msg_id': 0, 'post_rate': schedule.post_rate,
+                         'polled_at': schedule.polled_at, 'next_poll_at': schedule.next_poll_at}
+                        for ch_id, schedule in schedules.items()],
+                       index_elements=['channel_id'],
+                       update=lambda excluded: {'post_rate': excluded.post_rate,
+                                                'polled_at': excluded.polled_at,
+                                                'next_poll_at': excluded.next_poll_at})
+
+    def _get_cached_entities(self, usernames: list[str]) -> dict[str, TypeChat]:
+        """Get not expired channel entities resolved on previous cycles, by username"""
+        expire_before = time.time() - self.settings.entity_ttl
+        cached = {}
+        with self.db.get_session() as session:
+            for chunk in chunked({username.lower() for username in usernames}):
+                query = self.db.select(ChannelUsernameMapping.username, ChannelMapping) \
+                               .join(ChannelMapping,
+                                     ChannelMapping.id == ChannelUsernameMapping.channel_id) \
+                               .filter(ChannelUsernameMapping.username.in_(chunk),
+                                       ChannelMapping.access_hash.is_not(None),
+                                       ChannelMapping.resolved_by == self.account,
+                                       ChannelMapping.resolved_at > expire_before)
+                ch_map: ChannelMapping
+                for username, ch_map in self.db.execute(session, query):
+                    cached[username] = Channel(id=ch_map.id, title=ch_map.title or ch_map.username,
+                                               photo=ChatPhotoEmpty(), date=None,
+                                               access_hash=ch_map.access_hash,
+                                               username=ch_map.username, broadcast=True)
+        return cached
+
+    def _cache_entities(self, resolved: dict[str, TypeChat]) -> None:
+        """Save resolved channel entities and usernames used to find them"""
+        now = time.time()
+        channels = {}
+        usernames = {}
+        for username, entt in resolved.items():
+            channels[entt.id] = {'id': entt.id, 'username': entt.username, 'title': entt.title,
+                                 'access_hash': entt.access_hash, 'resolved_at': now,
+                                 'resolved_by': self.account}
+            for name in (username, entt.username):
+                usernames[name.lower()] = {'username': name.lower(), 'channel_id': entt.id,
+                                           'seen_at': now}
+        with self.db.get_session() as session, session.begin():
+            self.db.upsert(session, ChannelMapping, list(channels.values()),
+                           index_elements=['id'])
+            self.db.upsert(session, ChannelUsernameMapping, list(usernames.values()),
+                           index_elements=['username'])
 
     def save_info(self, session: Session, channels: list[ChannelUpd],
-                  messages: list[list[MessageUpd]]) -> None:
-        """Save info about new messages to database"""
+                  messages: list[list[MessageUpd]], checkpoint: bool = True) -> None:
+        """Save info about new messages to database.
+           With checkpoint channel cursors are moved to the saved messages, so it should be set
+           only when all older messages of these channels are saved.
+        """
         self.logger.info('update database')
-        for channel in channels:
-            ch_map = ChannelMapping(id=channel.id, username=channel.username)
-            self.logger.debug('save %s to database', ch_map)
-            self.db.insert(session, ch_map)
-        for msg_group in messages:
-            for msg in msg_group:
-                msg_map = MessageMapping(msg_id=msg.msg_id, group_id=msg.group_id,
-                                         channel_id=msg.channel_id, hash=msg.sha256)
-                self.logger.debug('save %s to database', msg_map)
-                self.db.insert(session, msg_map)
+        self.db.upsert(session, ChannelMapping,
+                       [{'id': channel.id, 'username': channel.username} for channel in channels],
+                       index_elements=['id'])
+        now = time.time()
+        compact = self.settings.dedup.compact_dedup_keys
+        rows = []
+        keys = {}
+        for dest in self.destinations:
+            for msg_group in messages:
+                if not dest.route.accepts(self._source(msg_group)):
+                    continue
+                for msg in msg_group:
+                    rows.append({'msg_id': msg.msg_id, 'group_id': msg.group_id,
+                                 'channel_id': msg.channel_id,
+                                 'hash': None if compact else msg.sha256,
+                                 'phash': to_signed(msg.phash) if msg.phash is not None else None,
+                                 'created_at': now, 'destination': dest.name})
+                    if compact:
+                        key = (dest.name, dedup_key(msg.sha256))
+                        keys[key] = {'destination': dest.name, 'key': key[1], 'created_at': now}
+                    dest.dedup.hash_filter.add(msg.sha256)
+        self.logger.debug('save %s messages to database', len(rows))
+        self.db.bulk_insert(session, MessageMapping, rows)
+        # content seen again stays in retention window longer
+        self.db.upsert(session, DedupKeyMapping, list(keys.values()),
+                       index_elements=['destination', 'key'])
+        if checkpoint:
+            self._save_channel_state(session, messages)
+
+    def _save_channel_state(self, session: Session, messages: list[list[MessageUpd]]) -> None:
+        """Move per-channel cursors forward to the latest saved messages"""
+        last_msg_ids: dict[int, int] = {}
+        for msg in itertools.chain.from_iterable(messages):
+            last_msg_ids[msg.channel_id] = max(last_msg_ids.get(msg.channel_id, 0), msg.msg_id)
+        self.db.upsert(session, ChannelStateMapping,
+                       [{'channel_id': ch_id, 'last_msg_id': msg_id}
+                        for ch_id, msg_id in last_msg_ids.items()],
+                       index_elements=['channel_id'],
+                       update=lambda excluded: {'last_msg_id': func.max(
+                           ChannelStateMapping.last_msg_id, excluded.last_msg_id)})
 
     async def _mainloop(self, sleep_time: float) -> None:
         """main program loop: subscribe, restore info, get content, send content, save content"""
         while True:
+            self.owner.profiler.cycle_started()
+            with CYCLE_SECONDS.time():
+                await self._cycle()
+            self.owner.profiler.cycle_finished()
+            for dest in self.destinations:
+                stats = dest.dedup.hash_filter_stats
+                HASH_FILTER_RATE.set(stats.hit_rate, kind='hit', destination=dest.name)
+                HASH_FILTER_RATE.set(stats.false_positive_rate, kind='false_positive',
+                                     destination=dest.name)
+            self.owner.metrics_exporter.write()
+            delay = sleep_time
+            next_poll_at = self.scheduler.next_poll_at()
+            if next_poll_at is not None:
+                delay = min(max(next_poll_at - time.time(), 0), sleep_time)
+            self.logger.debug('sleep %ss', delay)
+            try:
+                await asyncio.wait_for(self.file_processor.wait_changed(
+                    self.settings.channel_file_check_interval), delay)
+                self.logger.info('channel file changed, start polling cycle')
+            except asyncio.TimeoutError:
+                pass
+
+    async def _cycle(self) -> None:
+        """Single polling cycle, only channels due by schedule are fetched"""
+        with STAGE_SECONDS.time(stage='enumerate'):
             channels = await self._enumerate_channels()
-            usernames = set(channel.username for channel in channels)
-            await self._subscribe_channels(channels, usernames)
+        channel_ids = set(channel.id for channel in channels)
+        with STAGE_SECONDS.time(stage='subscribe'):
+            await self._subscribe_channels(channels)
+        async with self.lock:
+            with self.db.get_session() as db_session, db_session.begin():
+                with STAGE_SECONDS.time(stage='restore'):
+                    for dest in self.destinations:
+                        if dest.dedup.hash_filter.is_full:
+                            await self.db.run(dest.dedup.warm_hash_filter, self.db, db_session)
+                    db_channels = await self.db.run(self.restore_info, db_session, channel_ids)
+                    new_channels = merge_infos(db_channels, channels)
+                    await self.db.run(self._restore_schedule, db_session, channel_ids)
+                await self.db.run(self.save_info, db_session, new_channels, [])
+                await self.db.run(db_session.commit)
+        channels = new_channels + db_channels
+        self._live_channels = {ch_info.id: ch_info for ch_info in channels}
+        polled_at = time.time()
+        due = self.scheduler.due(polled_at, channel_ids)
+        self.logger.info('poll %s of %s channels', len(due), len(channels))
+        posts = dict.fromkeys(due, 0)
+        failed: set[int] = set()
+        # every batch is committed in its own short transaction together with channel cursors
+        # and outbox posts made of it, so after a crash polling resumes from the last batch
+        # and nothing is posted twice. Fetching goes on while the batch is saved.
+        async for messages in STAGE_SECONDS.time_iter(
+                self._stream_messages([ch for ch in channels if ch.id in due], failed),
+                stage='fetch'):
+            with STAGE_SECONDS.time(stage='thumbnails'):
+                await self._prefetch_phashes(messages)
+            async with self.lock:
+                with self.db.get_session() as db_session, db_session.begin():
+                    with STAGE_SECONDS.time(stage='dedup'):
+                        await self._post_messages(messages, db_session)
+                    with STAGE_SECONDS.time(stage='save'):
+                        await self.db.run(self.save_info, db_session, [], messages)
+                        await self.db.run(db_session.commit)
+                self._commit_phashes()
+                self._update_latest_saved(messages)
+            self._wake_senders()
+            for msg_group in messages:
+                posts[msg_group[0].channel_id] += 1
+        # posts of channels fetched partially say nothing about their post rate
+        schedules = {ch_id: self.scheduler.polled(ch_id, count, polled_at)
+                     if ch_id not in failed else self.scheduler.retry(ch_id, polled_at)
+                     for ch_id, count in posts.items()}
+        with self.db.get_session() as db_session, db_session.begin():
+            await self.db.run(self._save_schedule, db_session, schedules)
+            await self.db.run(db_session.commit)
+        for dest in self.destinations:
+            # records are formatted later in the log writer thread, so log copies
+            self.logger.info('destination %r hash filter stats: %s, content filter hits: %s',
+                             dest.name, str(dest.dedup.hash_filter_stats),
+                             dict(dest.content_filter.hits))
+
+    async def _stream_messages(self, channels: list[ChannelUpd], failed: set[int]) \
+        -> AsyncIterator[list[list[MessageUpd]]]:
+        """Yield batches of new message groups from all channels.
+           At most settings.fetch_concurrency channels are fetched at once and together they may
+           get ahead of the consumer by settings.fetch_buffer groups per channel only, so memory
+           stays bounded however long the catch-up is. Groups of a channel are yielded oldest
+           first, groups of different channels interleave as they come, so a channel sleeping
+           on flood wait does not hold back the others.
+           Ids of channels which were not fetched completely are added to failed.
+        """
+        pending = iter(channels)
+        queue: asyncio.Queue = asyncio.Queue(
+            self.settings.fetch_buffer * self.settings.fetch_concurrency)
+        tasks: dict[int, asyncio.Task] = {}
+
+        def start_next() -> None:
+            ch_info = next(pending, None)
+            if ch_info is not None:
+                tasks[ch_info.id] = asyncio.create_task(self._fetch_channel(ch_info, queue))
+
+        for _ in range(self.settings.fetch_concurrency):
+            start_next()
+        batch: list[list[MessageUpd]] = []
+        try:
+            while tasks:
+                ch_id, group = await queue.get()
+                if group is None:
+                    # channel is done, raise unexpected errors of its fetch
+                    if not await tasks.pop(ch_id):
+                        failed.add(ch_id)
+                    start_next()
+                else:
+                    batch.append(group)
+                # do not keep fetched groups while the rest of channels is waited for
+                if batch and (len(batch) >= self.settings.batch_size or queue.empty()):
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    async def _fetch_channel(self, ch_info: ChannelUpd, queue: asyncio.Queue) -> bool:
+        """Put (channel id, group) of single channel to queue, (channel id, None) when done.
+           Retry from the last group put after short flood wait, give up on timeout,
+           long flood wait or other telegram error. Return whether all new groups were put.
+        """
+        msg_id = ch_info.latest_saved_msg_id
+        cancelled = False
+        try:
+            for attempt in range(self.settings.flood_retries + 1):
+                try:
+                    async for group in self._get_messages_since_id(ch_info.entt, msg_id):
+                        await queue.put((ch_info.id, group))
+                        msg_id = group[0].msg_id
+                    return True
+                except FloodWaitError as err:
+                    if attempt == self.settings.flood_retries \
+                            or err.seconds > self.settings.max_flood_wait:
+                        self.logger.error('Flood wait %ss for channel %s, '
+                                          'give up until next cycle', err.seconds,
+                                          ch_info.username)
+                        return False
+                    # only this channel waits, others keep fetching
+                    self.logger.warning('Flood wait for channel %s, sleep %ss',
+                                        ch_info.username, err.seconds)
+                    FLOOD_WAIT_SECONDS.inc(err.seconds, source='fetch')
+                    await asyncio.sleep(err.seconds)
+                except RPCError as err:
+                    # e.g. channel became private, other channels are fetched anyway
+                    self.logger.error('Can not fetch channel %s, skip until next cycle: %s',
+                                      ch_info.username, err)
+                    return False
+                except asyncio.TimeoutError:
+                    self.logger.error('Timeout while fetching channel %s, skip until next cycle',
+                                      ch_info.username)
+                    return False
+            return False
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # consumer cancels fetches once it stops reading, queue may be full then
+            if not cancelled:
+                await queue.put((ch_info.id, None))
+
+    def _update_latest_saved(self, messages: list[list[MessageUpd]]) -> None:
+        """Move latest saved messages of live updates channels forward"""
+        for msg in itertools.chain.from_iterable(messages):
+            ch_info = self._live_channels[msg.channel_id]
+            ch_info.latest_saved_msg_id = max(ch_info.latest_saved_msg_id or 0, msg.msg_id)
+        # messages up to polling cursor are saved anyway, forget live ones there
+        for ch_id in {msg_group[0].channel_id for msg_group in messages}:
+            live_saved = self._live_saved.get(ch_id)
+            if live_saved:
+                cursor = self._live_channels[ch_id].latest_saved_msg_id
+                self._live_saved[ch_id] = {msg_id for msg_id in live_saved if msg_id > cursor}
+
+    def _commit_phashes(self) -> None:
+        for dest in self.destinations:
+            dest.dedup.commit_phashes()
+
+    def _wake_senders(self) -> None:
+        for dest in self.destinations:
+            dest.outbox.wake()
+
+    def _source(self, msg_group: list[MessageUpd]) -> Optional[str]:
+        """Username of channel message group comes from"""
+        ch_info = self._live_channels.get(msg_group[0].channel_id)
+        return ch_info.username if ch_info else None
+
+    def _live_channel(self, chat_id: int) -> Optional[ChannelUpd]:
+        """Get channel for update's marked chat id if we are listening to it"""
+        return self._live_channels.get(utils.resolve_id(chat_id)[0])
+
+    async def _on_new_message(self, event: events.NewMessage.Event) -> None:
+        """Live updates handler for single messages, albums are handled by _on_album"""
+        if event.message.grouped_id is not None:
+            return
+        ch_info = self._live_channel(event.chat_id)
+        if ch_info is None:
+            return
+        m_upd = self._make_message_upd(event.message, ch_info.id)
+        if m_upd is not None:
+            await self._process_live(ch_info, [m_upd])
+
+    async def _on_album(self, event: events.Album.Event) -> None:
+        """Live updates handler for albums"""
+        ch_info = self._live_channel(event.chat_id)
+        if ch_info is None:
+            return
+        # keep the same order as groups from polling: latest message first
+        msgs = sorted(event.messages, key=lambda msg: msg.id, reverse=True)
+        group = [m_upd for m_upd in (self._make_message_upd(msg, ch_info.id) for msg in msgs)
+                 if m_upd is not None]
+        if group:
+            await self._process_live(ch_info, group)
+
+    async def _process_live(self, ch_info: ChannelUpd, group: list[MessageUpd]) -> None:
+        """Push message group from live updates through the same dedup and post path"""
+        await self._prefetch_phashes([group])
+        async with self.lock:
+            # polling cycle or another update might already save this group
+            # while we were waiting for the lock, cycle also replaces channel info
+            ch_info = self._live_channels.get(ch_info.id, ch_info)
+            live_saved = self._live_saved.setdefault(ch_info.id, set())
+            if any(msg.msg_id <= (ch_info.latest_saved_msg_id or 0) or msg.msg_id in live_saved
+                   for msg in group):
+                self.logger.debug('skip live group %s, already saved', group)
+                return
+            self.logger.info('got new live group from %s', ch_info.username)
             with self.db.get_session() as db_session, db_session.begin():
-                db_channels = self.restore_info(db_session, usernames)
-                new_channels = merge_infos(db_channels, channels)
-                channels = new_channels + db_channels
-                messages = []
-                for ch_info in channels:
-                    messages.extend(await self._get_messages_since_id(ch_info.entt,
-                                                                      ch_info.latest_saved_msg_id))
-                await self._post_messages(messages, db_session)
-                self.save_info(db_session, new_channels, messages)
-                db_session.commit()
-            self.logger.debug('sleep %ss', sleep_time)
-            await asyncio.sleep(sleep_time)
+                await self._post_messages([group], db_session)
+                # live group may be newer than messages polling has not saved yet,
+                # so cursor is not moved, polling finds the group and dedups it
+                await self.db.run(self.save_info, db_session, [], [group], checkpoint=False)
+                await self.db.run(db_session.commit)
+            self._commit_phashes()
+            self._wake_senders()
+            # polling cursor stays, so messages missed before this group are still fetched
+            live_saved.update(msg.msg_id for msg in group)
+
+    def _make_message_upd(self, msg: Message, channel_id: int) -> Optional[MessageUpd]:
+        """Convert telethon message to MessageUpd, None if message is not interesting for us"""
+        if not msg.video and not msg.photo and not msg.gif:
+            self.msg_logger.debug('Msg with id %s: is not photo, video or gif', msg.id)
+            return None
+        try:
+            entities = tuple(sorted({type(entity).__name__ for entity in msg.entities or ()}))
+            return MessageUpd(msg.id, msg.grouped_id, channel_id, msg.text, msg.media, entities)
+        except ValueError as v:
+            self.logger.error('Unknown message media type: %s, err: %s', type(msg.media), v)
+        return None
 
     async def _get_messages_since_id(self, channel: TypeChat, msg_id: int = 0) \
-        -> list[list[MessageUpd]]:
-        """Get messages from channel starting from msg_id"""
-        messages = []
-        # fetch all messages (but no more then 3000) if we already have something from this channel,
-        # else fetch 10 latest message (max in one group) only
-        limit = 3000 if msg_id else 10
+        -> AsyncIterator[list[MessageUpd]]:
+        """Yield message groups from channel starting from msg_id, oldest first"""
+        if msg_id:
+            # fetch all messages (but no more then 3000) if we already have something
+            # from this channel, oldest first, so the next cycle continues where this one stopped
+            msgs = self._iter_with_timeout(
+                self.client.iter_messages(channel, limit=3000, min_id=msg_id, reverse=True))
+            async for group in self._group_messages(channel, msgs):
+                # groups are stored latest message first, as iter_messages returns them by default
+                yield group[::-1]
+        else:
+            # else fetch 10 latest message (max in one group) only
+            msgs = self._iter_with_timeout(self.client.iter_messages(channel, limit=10))
+            groups = [group async for group in self._group_messages(channel, msgs)]
+            for group in groups[::-1]:
+                yield group
+
+    async def _iter_with_timeout(self, iterator: AsyncIterator[Message]) \
+        -> AsyncIterator[Message]:
+        """Raise asyncio.TimeoutError if the next message takes more than fetch_timeout"""
+        while True:
+            # not wait_for: it loses cancellation if the message comes at the same time,
+            # and cancelled fetch would block on the queue nobody reads
+            # anext builtin needs python 3.10
+            # pylint: disable-next=unnecessary-dunder-call
+            next_msg = asyncio.ensure_future(iterator.__anext__())
+            try:
+                done, _ = await asyncio.wait({next_msg}, timeout=self.settings.fetch_timeout)
+            finally:
+                next_msg.cancel()
+            if not done:
+                raise asyncio.TimeoutError
+            try:
+                msg = next_msg.result()
+            except StopAsyncIteration:
+                return
+            yield msg
+
+    async def _group_messages(self, channel: TypeChat, msgs: AsyncIterator[Message]) \
+        -> AsyncIterator[list[MessageUpd]]:
+        """Join consecutive messages of the same album into groups"""
+        group: list[MessageUpd] = []
         last_grouped_id = None
         msg: Message
-        async for msg in self.client.iter_messages(channel, limit=limit, min_id=msg_id):
-            logging.debug('get msg from chat %s, msg:', channel.title)
-            logging.debug(msg.stringify())
-            if not msg.video and not msg.photo and not msg.gif:
-                logging.debug('Msg with id %s: is not photo, video or gif', msg.id)
+        async for msg in msgs:
+            self.msg_logger.debug('get msg from chat %s, msg: %s', channel.title,
+                                  Lazy(msg.stringify))
+            MESSAGES.inc(outcome='fetched')
+            m_upd = self._make_message_upd(msg, channel.id)
+            if m_upd is None:
+                MESSAGES.inc(outcome='filtered')
                 continue
-            if msg.grouped_id is None or msg.grouped_id != last_grouped_id:
-                last_grouped_id = msg.grouped_id
-                messages.append([])
-            try:
-                urls = msg.get_entities_text(MessageEntityTextUrl)
-                m_upd = MessageUpd(msg.id, msg.grouped_id, channel.id, msg.text, msg.media,
-                                   bool(urls))
-                messages[-1].append(m_upd)
-            except ValueError as v:
-                self.logger.error('Unknown message media type: %s, err: %s', type(msg.media), v)
-        return messages
-
-    def _get_posted(self, hashes: Iterable[bytes], db_session: Session) -> set[bytes]:
-        """Select only those hashes from hashes, which exists in database"""
-        return frozenset(self.db.execute_query(db_session,
-                                               self.db.select(MessageMapping.hash)
-                                                      .filter(MessageMapping.hash.in_(hashes)))
-                                                      .all())
-
-    def _is_text_ok(self, msg_text: str, url: bool):
-        """Do my best to filter out messages"""
-        if url:
-            # probably some advertisement link
-            return False
-        if len(msg_text) > 50:
-            # too long for meme
-            return False
-        if '#' in msg_text:
-            # probably some #adv tag
-            return False
-        return True
+            if group and (msg.grouped_id is None or msg.grouped_id != last_grouped_id):
+                yield group
+                group = []
+            last_grouped_id = msg.grouped_id
+            group.append(m_upd)
+        if group:
+            yield group
+
+    async def _prefetch_phashes(self, messages: list[list[MessageUpd]]) -> None:
+        """Hash thumbnails before batch takes dedup lock, so other bots do not wait
+           for the downloads. Media saved for every destination is most likely an exact
+           duplicate, it is not downloaded.
+        """
+        await self._fill_phashes(
+            msg for msg in itertools.chain.from_iterable(messages)
+            if not all(msg.sha256 in dest.dedup.hash_filter for dest in self.destinations))
+
+    async def _fill_phashes(self, messages: Iterable[MessageUpd]) -> None:
+        """Hash downloaded thumbnails of media without inlined one"""
+        if not self.settings.download_thumbs:
+            return
+        semaphore = asyncio.Semaphore(self.settings.fetch_concurrency)
+
+        async def fill(msg: MessageUpd) -> None:
+            async with semaphore:
+                msg.phash = await self._download_phash(msg.media)
+
+        await asyncio.gather(*(fill(msg) for msg in messages if msg.phash is None))
+
+    async def _download_phash(self, media: TypeMessageMedia) -> Optional[int]:
+        """Perceptual hash of the smallest thumbnail, cached so reposts are not downloaded again"""
+        key = media_key(media, thumb=True)
+        if key is None:
+            return None
+        try:
+            thumb = await self.owner.media_cache.read(
+                key, lambda path: self.client.download_media(media, file=path, thumb=0))
+        except (RPCError, OSError, ValueError) as err:
+            self.logger.warning('failed to download thumbnail %s: %s', key, err)
+            return None
+        return image_phash(thumb) if thumb else None
 
     async def _post_messages(self, messages: list[list[MessageUpd]], db_session: Session) -> None:
-        """Post messages to main_channel"""
-        posted = self._get_posted(map(lambda msg: msg.sha256,
-                                      itertools.chain.from_iterable(messages)),
-                                  db_session)
-        # Post in reverse order, since we add latest messages to the end of list
-        for msg_group in messages[::-1]:
-            # do not post messages if full group posted already
-            # if only some messages from the group exist - it may be new meme
-            if set(map(lambda msg: msg.sha256, msg_group)).issubset(posted):
-                continue
-            text = ''
-            files = []
-            url = False
-            for msg in msg_group[::-1]:
-                text = msg.text or text
-                url = msg.url or url
-                files.append(msg.media)
-            if not self._is_text_ok(text, url):
-                # do not post this message, but save it to db to filter it out on the previous step.
+        """Put messages to outboxes of destinations they are routed to,
+           they are posted after db_session commit
+        """
+        routed = []
+        for dest in self.destinations:
+            # left by a batch which was rolled back
+            dest.dedup.pending_phashes.clear()
+            groups = [msg_group for msg_group in messages
+                      if dest.route.accepts(self._source(msg_group))]
+            hashes = [msg.sha256 for msg in itertools.chain.from_iterable(groups)]
+            posted = await self.db.run(dest.dedup.get_posted, self.db, hashes, db_session)
+            fresh = dest.unposted(groups, posted)
+            routed.append((dest, fresh, posted))
+        for dest, fresh, posted in routed:
+            dest.enqueue(fresh, posted, db_session, self._source)
+
+    async def _enumerate_channels(self) -> list[TypeChat]:
+        """Get channels from channel file.
+           Only channels added to the file, not resolved yet or with expired entities are resolved,
+           entities of the rest are kept from previous cycles.
+        """
+        diff = self.file_processor.refresh()
+        if diff is not None:
+            for channel_uname in diff.removed:
+                self._entities.pop(channel_uname, None)
+            # edited file may fix typos, try failed channels again
+            self._resolve_failed.clear()
+        now = time.time()
+        expire_before = now - self.settings.entity_ttl
+        retry_before = now - self.settings.resolve_retry_interval
+        channels_username = [channel_uname for channel_uname in self.file_processor.channels
+                             if (channel_uname not in self._entities
+                                 or self._entities[channel_uname][1] <= expire_before)
+                             and self._resolve_failed.get(channel_uname, 0.) <= retry_before]
+        if channels_username and now >= self._resolve_after:
+            await self._resolve_channels(channels_username)
+        return [self._entities[channel_uname][0] for channel_uname in self.file_processor.channels
+                if channel_uname in self._entities]
+
+    async def _resolve_channels(self, channels_username: list[str]) -> None:
+        """Find entities of channels, from database cache or asking telegram"""
+        cached = await self.db.run(self._get_cached_entities, channels_username)
+        resolved = {}
+        now = time.time()
+        for channel_uname in channels_username:
+            entt = cached.get(channel_uname.lower())
+            if entt is not None:
+                self._entities[channel_uname] = (entt, now)
                 continue
             try:
-                await self.client.send_file(self.main_channel, files, caption=text)
-            except (telethon.errors.rpcbaseerrors.BadRequestError, TypeError) as err:
-                self.logger.error("Can't send media: %s", err)
+                entt = await self._resolve_channel(channel_uname)
+            except FloodWaitError as err:
+                # the rest of channels is resolved on the next cycles
+                self.logger.warning('Flood wait while resolving channel %s, retry in %ss',
+                                    channel_uname, err.seconds)
+                FLOOD_WAIT_SECONDS.inc(err.seconds, source='resolve')
+                self._resolve_after = time.time() + err.seconds
+                break
+            if entt is None:
+                self._resolve_failed[channel_uname] = now
+                continue
+            self._resolve_failed.pop(channel_uname, None)
+            self._entities[channel_uname] = (entt, now)
+            resolved[channel_uname] = entt
+        self.logger.info('channels: %s from cache, %s resolved', len(cached), len(resolved))
+        if resolved:
+            await self.db.run(self._cache_entities, resolved)
 
-    async def _enumerate_channels(self) -> list[TypeChat]:
-        """Get already subscribed channels"""
-        channels_username = self.file_processor.channel_generator()
-        channels = []
+    async def _resolve_channel(self, channel_uname: str) -> Optional[TypeChat]:
+        """Ask telegram for channel entity, None if channel can not be found"""
         tme_prefix='https://t.me/'
         joinchat='joinchat/'
-        for channel_uname in channels_username:
-            if channel_uname.startswith(tme_prefix):
-                # TODO: how to manage closed channels?
-                # i.e. what to use instead of username? hash?
-                link = channel_uname\
-                        .replace(tme_prefix, '').replace(joinchat, '', 1).replace('+', '', 1)
-                self.logger.debug('trying to joing via link: %s', link)
-                try:
-                    upd: Updates = await self.client(ImportChatInviteRequest(link))
-                    self.logger.debug('get upd from private channel: %s', upd.stringify())
-                    # channels.append(upd) ??
-                except (telethon.errors.rpcerrorlist.InviteHashExpiredError,
-                        telethon.errors.rpcerrorlist.InviteHashEmptyError,
-                        telethon.errors.rpcerrorlist.InviteHashInvalidError,
-                        telethon.errors.rpcerrorlist.UserAlreadyParticipantError,
-                        telethon.errors.rpcerrorlist.InviteRequestSentError,) as err:
-                    self.logger.error('Error while trying to join private channel: %s', err)
-            else:
-                try:
-                    ent = await self.client.get_input_entity(channel_uname)
-                    channels.append(await self.client.get_entity(ent))
-                except ValueError:
-                    self.logger.error("Can't find input_entity for channel: %s", channel_uname)
-        return channels
-
-    async def _subscribe_channels(self, channels: list[TypeChat], subscribed: set[str]) -> None:
-        """Subscribe to channels"""
+        if channel_uname.startswith(tme_prefix):
+            # TODO: how to manage closed channels?
+            # i.e. what to use instead of username? hash?
+            link = channel_uname\
+                    .replace(tme_prefix, '').replace(joinchat, '', 1).replace('+', '', 1)
+            self.logger.debug('trying to joing via link: %s', link)
+            try:
+                upd: Updates = await self.client(ImportChatInviteRequest(link))
+                self.logger.debug('get upd from private channel: %s', Lazy(upd.stringify))
+                # channels.append(upd) ??
+            except (telethon.errors.rpcerrorlist.InviteHashExpiredError,
+                    telethon.errors.rpcerrorlist.InviteHashEmptyError,
+                    telethon.errors.rpcerrorlist.InviteHashInvalidError,
+                    telethon.errors.rpcerrorlist.UserAlreadyParticipantError,
+                    telethon.errors.rpcerrorlist.InviteRequestSentError,) as err:
+                self.logger.error('Error while trying to join private channel: %s', err)
+            return None
+        try:
+            ent = await self.client.get_input_entity(channel_uname)
+            return await self.client.get_entity(ent)
+        except ValueError:
+            self.logger.error("Can't find input_entity for channel: %s", channel_uname)
+        return None
+
+    async def _joined_channels(self) -> set[int]:
+        """Ids of channels the account is a member of, live updates come from them only"""
+        if self._joined is None:
+            self._joined = {dialog.entity.id async for dialog in self.client.iter_dialogs()
+                            if dialog.is_channel}
+            self.logger.info('account is a member of %s channels', len(self._joined))
+        return self._joined
+
+    async def _subscribe_channels(self, channels: list[TypeChat]) -> None:
+        """Subscribe to channels the account is not a member of yet"""
         err_msg = 'Unable to join channel: %s, reason: %s'
+        if time.time() < self._join_after:
+            return
+        joined = await self._joined_channels()
         # TODO: Mute and archive all chats
         for channel in channels:
-            info = f'{channel.title} (@{channel.username})'
-            if channel.username in subscribed:
-                self.logger.debug('skip channel %s, already subscribed', info)
+            if channel.id in joined or channel.id in self._join_failed:
                 continue
+            info = f'{channel.title} (@{channel.username})'
+            # errors below are not going away, do not retry them every cycle
+            self._join_failed.add(channel.id)
             try:
                 result = await self.client(JoinChannelRequest(channel))
-                self.logger.info('Join channel request result: %s', result.stringify())
+                self.logger.info('Join channel request result: %s', Lazy(result.stringify))
+                joined.add(channel.id)
+                self._join_failed.discard(channel.id)
+            except FloodWaitError as err:
+                # the rest of channels is joined on the next cycles
+                self._join_failed.discard(channel.id)
+                self.logger.warning('Flood wait while joining channel %s, retry in %ss',
+                                    info, err.seconds)
+                FLOOD_WAIT_SECONDS.inc(err.seconds, source='join')
+                self._join_after = time.time() + err.seconds
+                return
             except ChannelsTooMuchError:
                 self.logger.error(
                     err_msg, info, 'You have joined too many channels/supergroups.')
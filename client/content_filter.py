@@ -0,0 +1,206 @@
+"""Configurable filter of message captions, replaces hardcoded checks of Bot._is_text_ok
+
+Rules are loaded from json file:
+{
+    "max_length": 50,
+    "min_length": 0,
+    "keywords": ["#", "promo"],
+    "regexes": ["t\\.me/\\S+"],
+    "blocked_entities": ["MessageEntityTextUrl", "MessageEntityMention"],
+    "ignore_case": true,
+    "channels": {
+        "some_channel": {"max_length": 200}
+    }
+}
+Keys of "channels" are source channel usernames, their rules replace the top-level ones.
+"""
+
+import json
+import logging
+import re
+from collections import deque
+from dataclasses import dataclass, fields
+from typing import Any, Iterable, Optional
+
+from metrics import FILTER_HITS
+
+DEFAULT_RULES: dict[str, Any] = {
+    # too long for meme
+    'max_length': 50,
+    # probably some #adv tag
+    'keywords': ['#'],
+    # probably some advertisement link
+    'blocked_entities': ['MessageEntityTextUrl'],
+}
+
+# Regexes which do not work inside one alternation: group numbers and names would change,
+# global flags are allowed only at the start of the whole pattern
+STANDALONE_REGEX = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|^\(\?[aiLmsux]+\)')
+
+
+class AhoCorasick:
+    """Finds all keywords occurring in text in a single pass over it"""
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.keywords = list(keywords)
+        # state -> char -> state, state 0 is root
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # keyword indexes ending in state, including ones reachable by fail links
+        self._output: list[list[int]] = [[]]
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(index)
+        self._build_fail_links()
+
+    def _build_fail_links(self) -> None:
+        # breadth first, so fail links of shallower states are ready when we need them,
+        # states right under the root fail to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + \
+                    self._output[self._fail[next_state]]
+
+    def find(self, text: str) -> set[int]:
+        """Indexes of keywords found in text"""
+        found: set[int] = set()
+        state = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+@dataclass
+class FilterRules:
+    """Rules for one source channel, or default ones"""
+
+    max_length: Optional[int] = None
+    min_length: int = 0
+    keywords: tuple[str, ...] = ()
+    regexes: tuple[str, ...] = ()
+    blocked_entities: tuple[str, ...] = ()
+    ignore_case: bool = True
+
+    @classmethod
+    def from_dict(cls, config: dict[str, Any]) -> 'FilterRules':
+        """Build rules from config section, unknown keys are errors"""
+        known = {field.name for field in fields(cls)}
+        unknown = set(config) - known
+        if unknown:
+            raise ValueError(f'Unknown filter rules: {", ".join(sorted(unknown))}')
+        values: dict[str, Any] = {key: tuple(value) if isinstance(value, list) else value
+                                  for key, value in config.items()}
+        return cls(**values)
+
+
+class CompiledRules:
+    """Rules prepared for fast matching: keywords in one automaton, regexes in one alternation,
+       except ones referring to their own groups, which are matched one by one
+    """
+
+    def __init__(self, rules: FilterRules) -> None:
+        self.rules = rules
+        keywords = [kw.lower() for kw in rules.keywords] if rules.ignore_case else rules.keywords
+        self.keywords = AhoCorasick(keywords) if keywords else None
+        flags = re.IGNORECASE if rules.ignore_case else 0
+        joined = []
+        self.standalone: list[tuple[str, re.Pattern]] = []
+        for i, regex in enumerate(rules.regexes):
+            try:
+                compiled = re.compile(regex, flags)
+            except re.error as err:
+                raise ValueError(f'Invalid filter regex {regex!r}: {err}') from err
+            if compiled.groupindex or STANDALONE_REGEX.search(regex):
+                self.standalone.append((regex, compiled))
+            else:
+                joined.append(f'(?P<r{i}>{regex})')
+        self.regex = re.compile('|'.join(joined), flags) if joined else None
+        self.blocked_entities = frozenset(rules.blocked_entities)
+
+    def check(self, text: str, entities: Iterable[str]) -> Optional[str]:
+        """Name of the first rule which rejects text, None if it is ok"""
+        # pylint: disable=too-many-return-statements
+        if self.rules.max_length is not None and len(text) > self.rules.max_length:
+            return 'max_length'
+        if len(text) < self.rules.min_length:
+            return 'min_length'
+        blocked = self.blocked_entities.intersection(entities)
+        if blocked:
+            return f'entity:{min(blocked)}'
+        if self.keywords is not None:
+            found = self.keywords.find(text.lower() if self.rules.ignore_case else text)
+            if found:
+                return f'keyword:{self.rules.keywords[min(found)]}'
+        if self.regex is not None:
+            match = self.regex.search(text)
+            # every alternative is a named group, so the matched one is known
+            if match and match.lastgroup:
+                return f'regex:{self.rules.regexes[int(match.lastgroup[1:])]}'
+        for regex, compiled in self.standalone:
+            if compiled.search(text):
+                return f'regex:{regex}'
+        return None
+
+
+@dataclass
+class Candidate:
+    """Caption of message group to check"""
+
+    text: str
+    entities: frozenset[str]
+    channel: Optional[str] = None
+
+
+class ContentFilter:
+    """Checks captions against default rules or rules of their source channel"""
+
+    def __init__(self, config: Optional[dict[str, Any]] = None) -> None:
+        config = dict(DEFAULT_RULES if config is None else config)
+        channels = config.pop('channels', {})
+        self.default = CompiledRules(FilterRules.from_dict(config))
+        self.channels = {username.lower(): CompiledRules(FilterRules.from_dict(rules))
+                         for username, rules in channels.items()}
+        self.hits: dict[str, int] = {}
+        self.logger = logging.getLogger('Main.content_filter')
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> 'ContentFilter':
+        """Load rules from json file, default rules if path is not set"""
+        if path is None:
+            return cls()
+        with open(path, encoding='utf-8') as config:
+            return cls(json.load(config))
+
+    def check_batch(self, candidates: list[Candidate]) -> list[Optional[str]]:
+        """For every candidate: name of rule which rejects it, None if it is ok"""
+        results = []
+        for candidate in candidates:
+            rules = self.channels.get((candidate.channel or '').lower(), self.default)
+            rule = rules.check(candidate.text, candidate.entities)
+            if rule is not None:
+                self.hits[rule] = self.hits.get(rule, 0) + 1
+                FILTER_HITS.inc(rule=rule)
+                self.logger.debug('caption rejected by %s: %s', rule, candidate.text)
+            results.append(rule)
+        return results
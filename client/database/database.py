@@ -1,17 +1,83 @@
 
-from typing import Type
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, Optional, Type, TypeVar
 
-from sqlalchemy import ScalarResult, Select, create_engine, select
+from sqlalchemy import Result, ScalarResult, Select, create_engine, event, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 
 from .database_mappings import BaseORM
+from .migrations import migrate
+
+T = TypeVar('T')
+
+# SQLite before 3.32 allows only 999 bound variables in one statement
+MAX_VARIABLES = 500
+
+
+def chunked(items: Iterable[T], size: int = MAX_VARIABLES) -> Iterator[list[T]]:
+    """Split items into lists of at most size elements, e.g. to fit SQLite variables limit"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@dataclass
+class SqliteSettings:
+    # WAL lets readers work while something is written and makes commits cheaper
+    journal_mode: str = 'WAL'
+    # NORMAL is safe with WAL: only the last transactions may be lost on power failure
+    synchronous: str = 'NORMAL'
+    # negative value is size in KiB, positive - in pages
+    cache_size: int = -64 * 1024
+    mmap_size: int = 256 * 1024 * 1024
+    # lets retention give pages of deleted rows back to filesystem without full VACUUM,
+    # applies to new databases only, existing ones are converted by retention
+    auto_vacuum: str = 'INCREMENTAL'
+    # connections are kept open between sessions, so pragmas and page cache are reused
+    pool_size: int = 5
 
 
 class Database:
 
-    def __init__(self, path: str) -> None:
-        self.engine = create_engine(f'sqlite+pysqlite:///{path}')
+    def __init__(self, path: str, settings: Optional[SqliteSettings] = None) -> None:
+        self.settings = settings or SqliteSettings()
+        self.engine = create_engine(f'sqlite+pysqlite:///{path}',
+                                    pool_size=self.settings.pool_size)
+        event.listen(self.engine, 'connect', self._set_pragmas)
         BaseORM.metadata.create_all(self.engine)
+        migrate(self.engine)
+        # SQLite has one writer anyway, single thread keeps queries in order
+        # and lets a session be used by consecutive run calls
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+
+    def _set_pragmas(self, dbapi_connection, _connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        # takes effect only if no tables exist yet, so set it first
+        cursor.execute(f'PRAGMA auto_vacuum = {self.settings.auto_vacuum}')
+        cursor.execute(f'PRAGMA journal_mode = {self.settings.journal_mode}')
+        cursor.execute(f'PRAGMA synchronous = {self.settings.synchronous}')
+        cursor.execute(f'PRAGMA cache_size = {self.settings.cache_size:d}')
+        cursor.execute(f'PRAGMA mmap_size = {self.settings.mmap_size:d}')
+        cursor.close()
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Call func in database thread, so queries do not block the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def close(self) -> None:
+        """Wait for queued calls and close connections"""
+        self._executor.shutdown()
+        self.engine.dispose()
 
     def get_session(self) -> Session:
         return Session(self.engine)
@@ -20,14 +86,47 @@ class Database:
     def insert(session: Session, object: BaseORM) -> None:
         session.add(object)
 
+    @staticmethod
+    def bulk_insert(session: Session, cls: Type[BaseORM], rows: list[dict[str, Any]]) -> None:
+        """Insert many rows with one executemany statement, skipping ORM unit of work"""
+        if rows:
+            session.execute(insert(cls), rows)
+
+    @staticmethod
+    def upsert(session: Session, cls: Type[BaseORM], rows: list[dict[str, Any]],
+               index_elements: list[str],
+               update: Optional[Callable[[Any], dict[str, Any]]] = None) -> None:
+        """Insert rows, update existing ones on index_elements conflict.
+           update gets row proposed for insertion (excluded) and returns columns to set,
+           by default all other columns are overwritten with new values.
+        """
+        if not rows:
+            return
+        for chunk in chunked(rows, MAX_VARIABLES // len(rows[0])):
+            query = sqlite_insert(cls).values(chunk)
+            if update is None:
+                set_ = {column: query.excluded[column] for column in chunk[0]
+                        if column not in index_elements}
+            else:
+                set_ = update(query.excluded)
+            if set_:
+                query = query.on_conflict_do_update(index_elements=index_elements, set_=set_)
+            else:
+                query = query.on_conflict_do_nothing(index_elements=index_elements)
+            session.execute(query)
+
     # TODO: Fix types, it should actually be Any?
     @staticmethod
-    def select(cls: Type[BaseORM]) -> Select[tuple[BaseORM]]:
-        return select(cls)
+    def select(*entities) -> Select:
+        return select(*entities)
 
     @staticmethod
     def execute_query(session: Session, query) -> ScalarResult[BaseORM]:
         return session.scalars(query)
 
+    @staticmethod
+    def execute(session: Session, query) -> Result:
+        return session.execute(query)
+
     def select_result(self, session: Session, cls: Type[BaseORM]) -> ScalarResult[BaseORM]:
         return session.scalars(self.select(cls))
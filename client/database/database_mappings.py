@@ -13,26 +13,122 @@ class Channel(BaseORM):
 
     __tablename__ = 'channels'
 
-    # Channel name might change, but should be unique anyway
-    # So use id as primary key, and update username if needed
-    # TODO: what if one of the saved channels renamed and other one takes its previous name??
+    # Channel name might change, so use id as primary key, and update username if needed.
+    # Username is not unique: a renamed channel keeps its old name here until it is resolved
+    # again, while another channel may already use it. channel_usernames maps names to ids.
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    username: Mapped[str] = mapped_column(unique=True)
+    username: Mapped[str]
+    # resolved entity cache, so we do not ask telegram about the same channel every cycle
+    title: Mapped[Optional[str]]
+    access_hash: Mapped[Optional[int]]
+    # unix timestamp
+    resolved_at: Mapped[Optional[float]]
+    # access_hash is different for every account, so remember which session resolved channel
+    resolved_by: Mapped[Optional[str]]
 
     def __repr__(self) -> str:
         return f'<Channel object, id: {self.id}, username: {self.username}>'
 
 
+class ChannelUsername(BaseORM):
+
+    __tablename__ = 'channel_usernames'
+
+    # Every username we have seen for a channel, old ones are kept,
+    # so channel file with previous username still points to the right channel
+
+    username: Mapped[str] = mapped_column(primary_key=True)
+    channel_id: Mapped[int] = mapped_column(ForeignKey('channels.id'), index=True)
+    # unix timestamp
+    seen_at: Mapped[float]
+
+    def __repr__(self) -> str:
+        return f'<ChannelUsername object, username: {self.username}, ' \
+               f'channel_id: {self.channel_id}>'
+
+
+class ChannelState(BaseORM):
+
+    __tablename__ = 'channel_state'
+
+    # Per-channel cursor, so we do not need to scan messages table to find where to continue from
+
+    channel_id: Mapped[int] = mapped_column(ForeignKey('channels.id'), primary_key=True)
+    last_msg_id: Mapped[int] = mapped_column(default=0)
+    # polling schedule: average posts per second and unix timestamps
+    post_rate: Mapped[Optional[float]]
+    polled_at: Mapped[Optional[float]]
+    next_poll_at: Mapped[Optional[float]]
+
+    def __repr__(self) -> str:
+        return f'<ChannelState object, channel_id: {self.channel_id}, ' \
+               f'last_msg_id: {self.last_msg_id}>'
+
+
+class Outbox(BaseORM):
+
+    __tablename__ = 'outbox'
+
+    # Posts approved for sending, deleted when sent
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    caption: Mapped[str]
+    # media objects in telegram serialization format
+    media: Mapped[bytes]
+    # unix timestamps
+    created_at: Mapped[float]
+    next_attempt_at: Mapped[float] = mapped_column(index=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    failed: Mapped[bool] = mapped_column(default=False)
+    error: Mapped[Optional[str]]
+    # set right before sending, if it is still set on start the post may be sent already
+    sending_at: Mapped[Optional[float]]
+    # name of destination post goes to, see routing module
+    destination: Mapped[str] = mapped_column(server_default='')
+    # messages media comes from, comma separated ids in media order.
+    # File references in media expire, so media is fetched again from them
+    channel_id: Mapped[Optional[int]]
+    msg_ids: Mapped[Optional[str]]
+
+    def __repr__(self) -> str:
+        return f'<Outbox object, id: {self.id}, attempts: {self.attempts}, failed: {self.failed}>'
+
+
+class DedupKey(BaseORM):
+
+    __tablename__ = 'dedup_keys'
+
+    # Compact alternative to messages.hash: first 8 bytes of hash as signed 64-bit integer.
+    # Table without rowid is a single b-tree ordered by key, so there is no separate index to keep
+
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # every destination has its own dedup history
+    destination: Mapped[str] = mapped_column(primary_key=True, server_default='')
+    key: Mapped[int] = mapped_column(primary_key=True)
+    # unix timestamp of the last time content was seen, old keys are pruned by retention
+    created_at: Mapped[float] = mapped_column(index=True)
+
+    def __repr__(self) -> str:
+        return f'<DedupKey object, destination: {self.destination}, key: {self.key}>'
+
+
 class Message(BaseORM):
 
     __tablename__ = 'messages'
 
     id: Mapped[int] = mapped_column(primary_key=True)
     msg_id: Mapped[int]
-    group_id = Mapped[Optional[int]]
+    group_id: Mapped[Optional[int]]
     channel_id: Mapped[int] = mapped_column(ForeignKey('channels.id'))
-    hash: Mapped[Optional[bytes]]
+    hash: Mapped[Optional[bytes]] = mapped_column(index=True)
+    # perceptual hash of media thumbnail, stored as signed 64-bit integer
+    phash: Mapped[Optional[int]]
+    # unix timestamp, old messages are pruned by retention
+    created_at: Mapped[Optional[float]] = mapped_column(index=True)
+    # name of destination message was routed to, it is saved once for every one of them
+    destination: Mapped[str] = mapped_column(server_default='')
 
     def __repr__(self) -> str:
         return f'<Message object, id: {self.id}, msg_id: {self.msg_id}, ' \
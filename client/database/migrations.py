@@ -0,0 +1,144 @@
+"""Schema migrations for databases created by previous versions of the bot"""
+
+import logging
+from typing import Callable
+
+from sqlalchemy import Connection, Engine, text
+
+logger = logging.getLogger('Main.database')
+
+
+def _fill_channel_state(connection: Connection) -> None:
+    # channel_state table itself is created by create_all, fill it from saved messages history
+    connection.execute(text('INSERT OR IGNORE INTO channel_state (channel_id, last_msg_id) '
+                            'SELECT channel_id, MAX(msg_id) FROM messages GROUP BY channel_id'))
+
+
+def _index_message_hash(connection: Connection) -> None:
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_hash ON messages (hash)'))
+
+
+def _add_message_phash(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(messages)'))}
+    if 'phash' not in columns:
+        connection.execute(text('ALTER TABLE messages ADD COLUMN phash INTEGER'))
+
+
+def _add_message_group_id(connection: Connection) -> None:
+    # group_id was declared by mistake as plain class attribute, so it never got its column
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(messages)'))}
+    if 'group_id' not in columns:
+        connection.execute(text('ALTER TABLE messages ADD COLUMN group_id INTEGER'))
+
+
+def _add_channel_entity_cache(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(channels)'))}
+    for column, column_type in (('title', 'VARCHAR'), ('access_hash', 'INTEGER'),
+                                ('resolved_at', 'FLOAT')):
+        if column not in columns:
+            connection.execute(text(f'ALTER TABLE channels ADD COLUMN {column} {column_type}'))
+    # channel_usernames table is created by create_all, remember current usernames
+    connection.execute(text('INSERT OR IGNORE INTO channel_usernames '
+                            '(username, channel_id, seen_at) '
+                            "SELECT lower(username), id, strftime('%s', 'now') FROM channels"))
+
+
+def _add_channel_resolved_by(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(channels)'))}
+    if 'resolved_by' not in columns:
+        connection.execute(text('ALTER TABLE channels ADD COLUMN resolved_by VARCHAR'))
+
+
+def _add_message_created_at(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(messages)'))}
+    if 'created_at' not in columns:
+        connection.execute(text('ALTER TABLE messages ADD COLUMN created_at FLOAT'))
+    # age of old messages is unknown, so their retention window starts now
+    connection.execute(text("UPDATE messages SET created_at = strftime('%s', 'now') "
+                            'WHERE created_at IS NULL'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_created_at '
+                            'ON messages (created_at)'))
+
+
+def _add_channel_state_schedule(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(channel_state)'))}
+    for column in ('post_rate', 'polled_at', 'next_poll_at'):
+        if column not in columns:
+            connection.execute(text(f'ALTER TABLE channel_state ADD COLUMN {column} FLOAT'))
+
+
+def _add_outbox_sending_at(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(outbox)'))}
+    if 'sending_at' not in columns:
+        connection.execute(text('ALTER TABLE outbox ADD COLUMN sending_at FLOAT'))
+
+
+def _add_destinations(connection: Connection) -> None:
+    # everything saved before belongs to the only destination, main channel, named ''
+    for table in ('messages', 'outbox'):
+        columns = {row.name for row in connection.execute(text(f'PRAGMA table_info({table})'))}
+        if 'destination' not in columns:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN destination VARCHAR "
+                                    "NOT NULL DEFAULT ''"))
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(dedup_keys)'))}
+    if 'destination' not in columns:
+        # primary key of table without rowid can not be altered, so copy it
+        connection.execute(text("CREATE TABLE dedup_keys_new (destination VARCHAR DEFAULT '' "
+                                'NOT NULL, key INTEGER NOT NULL, created_at FLOAT NOT NULL, '
+                                'PRIMARY KEY (destination, key)) WITHOUT ROWID'))
+        connection.execute(text("INSERT INTO dedup_keys_new SELECT '', key, created_at "
+                                'FROM dedup_keys'))
+        connection.execute(text('DROP TABLE dedup_keys'))
+        connection.execute(text('ALTER TABLE dedup_keys_new RENAME TO dedup_keys'))
+        connection.execute(text('CREATE INDEX ix_dedup_keys_created_at '
+                                'ON dedup_keys (created_at)'))
+
+
+def _drop_channel_username_unique(connection: Connection) -> None:
+    # renamed channel keeps its old username until resolved again, another one may take it
+    indexes = connection.execute(text('PRAGMA index_list(channels)'))
+    if any(row.unique and row.origin == 'u' for row in indexes):
+        # SQLite can not drop a constraint, so copy the table
+        connection.execute(text('CREATE TABLE channels_new (id INTEGER NOT NULL, '
+                                'username VARCHAR NOT NULL, title VARCHAR, access_hash INTEGER, '
+                                'resolved_at FLOAT, resolved_by VARCHAR, PRIMARY KEY (id))'))
+        connection.execute(text('INSERT INTO channels_new SELECT id, username, title, '
+                                'access_hash, resolved_at, resolved_by FROM channels'))
+        connection.execute(text('DROP TABLE channels'))
+        connection.execute(text('ALTER TABLE channels_new RENAME TO channels'))
+
+
+def _add_outbox_source(connection: Connection) -> None:
+    columns = {row.name for row in connection.execute(text('PRAGMA table_info(outbox)'))}
+    if 'channel_id' not in columns:
+        connection.execute(text('ALTER TABLE outbox ADD COLUMN channel_id INTEGER'))
+    if 'msg_ids' not in columns:
+        connection.execute(text('ALTER TABLE outbox ADD COLUMN msg_ids VARCHAR'))
+
+
+# Migration with index i upgrades schema from version i to version i + 1.
+# Migrations run after create_all, so they also run on fresh databases and must be idempotent.
+MIGRATIONS: list[Callable[[Connection], None]] = [
+    _fill_channel_state,
+    _index_message_hash,
+    _add_message_phash,
+    _add_message_group_id,
+    _add_channel_entity_cache,
+    _add_channel_resolved_by,
+    _add_message_created_at,
+    _add_channel_state_schedule,
+    _add_outbox_sending_at,
+    _add_destinations,
+    _drop_channel_username_unique,
+    _add_outbox_source,
+]
+
+
+def migrate(engine: Engine) -> None:
+    """Apply all migrations newer than database schema version"""
+    with engine.begin() as connection:
+        version = connection.execute(text('PRAGMA user_version')).scalar_one()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info('migrate database to version %s: %s', number, migration.__name__)
+            migration(connection)
+            connection.execute(text(f'PRAGMA user_version = {number}'))
@@ -0,0 +1,218 @@
+"""Destination channels: what was posted to them, their content filters and send queues"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
+from content_filter import Candidate, ContentFilter
+from database.database import Database, chunked
+from database.database_mappings import DedupKey as DedupKeyMapping
+from database.database_mappings import Message as MessageMapping
+from hash_filter import BloomFilter, HashFilterStats, dedup_key, dedup_key_bytes
+from metrics import MESSAGES
+from outbox import Outbox
+from phash import PHashIndex, hamming, is_informative, to_unsigned
+from routing import Route
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+if TYPE_CHECKING:
+    # bot imports this module
+    from bot import MessageUpd
+
+
+@dataclass
+class DedupSettings:
+    """Tunables of duplicate detection, the same for every destination"""
+
+    # expected number of saved hashes, filter grows if database has more
+    hash_filter_capacity: int = 1_000_000
+    hash_filter_error_rate: float = 0.001
+    # max number of different bits in thumbnails perceptual hashes to consider media the same
+    phash_threshold: int = 4
+    # store dedup keys as 8-byte integers in dedup_keys table instead of full hashes in messages
+    compact_dedup_keys: bool = False
+
+
+class DedupState:
+    """What was already posted to destination: shared by all bots saving messages
+       to the same database
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, settings: DedupSettings, destination: str = '',
+                 lock: Optional[asyncio.Lock] = None) -> None:
+        self.settings = settings
+        self.destination = destination
+        self.logger = logging.getLogger('Main.dedup')
+        self.hash_filter = BloomFilter(1)
+        self.hash_filter_stats = HashFilterStats()
+        self.phash_index = PHashIndex(settings.phash_threshold)
+        # perceptual hashes of the batch being saved, indexed only once it is committed
+        self.pending_phashes: list[int] = []
+        # dedup_keys has keys of this destination while full hashes are saved,
+        # e.g. compact keys were enabled before, so history is looked up in both tables
+        self.legacy_keys = False
+        # polling cycles and live updates of all bots share database and dedup state,
+        # so process one batch at a time. Every batch goes to all destinations,
+        # so their dedup states share the lock
+        self.lock = lock or asyncio.Lock()
+        # filters are loaded from database
+        self.ready = False
+
+    def warm_hash_filter(self, db: Database, session: Session) -> None:
+        """Build hash filter from all dedup keys saved to database"""
+        key_count = db.execute(session, db.select(func.count(DedupKeyMapping.key))
+                                          .filter(DedupKeyMapping.destination
+                                                  == self.destination)).scalar_one()
+        hash_count = 0
+        if not self.settings.compact_dedup_keys:
+            hash_count = db.execute(session, db.select(func.count(MessageMapping.hash))
+                                               .filter(MessageMapping.destination
+                                                       == self.destination)).scalar_one()
+        self.legacy_keys = not self.settings.compact_dedup_keys and key_count > 0
+        capacity = max(self.settings.hash_filter_capacity, 2 * (key_count + hash_count))
+        self.logger.info('build hash filter of destination %r for %s hashes, capacity: %s',
+                         self.destination, key_count + hash_count, capacity)
+        self.hash_filter = BloomFilter(capacity, self.settings.hash_filter_error_rate)
+        keys = db.select(DedupKeyMapping.key) \
+                 .filter(DedupKeyMapping.destination == self.destination) \
+                 .execution_options(yield_per=10_000)
+        for key in db.execute(session, keys).scalars():
+            self.hash_filter.add(dedup_key_bytes(key))
+        if not self.settings.compact_dedup_keys:
+            hashes = db.select(MessageMapping.hash) \
+                       .filter(MessageMapping.hash.is_not(None),
+                               MessageMapping.destination == self.destination) \
+                       .execution_options(yield_per=10_000)
+            for msg_hash in db.execute(session, hashes).scalars():
+                self.hash_filter.add(msg_hash)
+
+    def warm_phash_index(self, db: Database, session: Session) -> None:
+        """Build near-duplicates index from all perceptual hashes saved to database"""
+        self.phash_index = PHashIndex(self.settings.phash_threshold)
+        query = db.select(MessageMapping.phash).filter(MessageMapping.phash.is_not(None),
+                                                       MessageMapping.destination
+                                                       == self.destination) \
+                  .execution_options(yield_per=10_000)
+        for phash in db.execute(session, query).scalars():
+            # flat images saved before they were excluded from near-duplicate matching
+            if is_informative(to_unsigned(phash)):
+                self.phash_index.add(to_unsigned(phash))
+        self.logger.info('built perceptual hash index of destination %r for %s hashes',
+                         self.destination, len(self.phash_index))
+
+    def get_posted(self, db: Database, hashes: Iterable[bytes],
+                   session: Session) -> frozenset[bytes]:
+        """Select only those hashes from hashes, which exists in destination history"""
+        unique_hashes = set(hashes)
+        # hashes not in the filter were never saved, no need to ask database about them
+        candidates = [msg_hash for msg_hash in unique_hashes if msg_hash in self.hash_filter]
+        posted: set[bytes] = set()
+        if not self.settings.compact_dedup_keys:
+            for chunk in chunked(candidates):
+                posted.update(db.execute(
+                    session, db.select(MessageMapping.hash)
+                               .filter(MessageMapping.destination == self.destination,
+                                       MessageMapping.hash.in_(chunk))).scalars())
+        if self.settings.compact_dedup_keys or self.legacy_keys:
+            by_key = {dedup_key(msg_hash): msg_hash for msg_hash in candidates
+                      if msg_hash not in posted}
+            for key_chunk in chunked(by_key):
+                posted.update(by_key[key] for key in db.execute(
+                    session, db.select(DedupKeyMapping.key)
+                               .filter(DedupKeyMapping.destination == self.destination,
+                                       DedupKeyMapping.key.in_(key_chunk))).scalars())
+        self.hash_filter_stats.lookups += len(unique_hashes)
+        self.hash_filter_stats.negatives += len(unique_hashes) - len(candidates)
+        self.hash_filter_stats.false_positives += len(candidates) - len(posted)
+        return frozenset(posted)
+
+    def seen_phash(self, value: int) -> bool:
+        """Whether similar picture was posted or is in the batch being saved"""
+        return value in self.phash_index or any(
+            hamming(value, pending) <= self.phash_index.threshold
+            for pending in self.pending_phashes)
+
+    def is_near_duplicate(self, msg_group: list['MessageUpd'], posted: frozenset[bytes]) -> bool:
+        """Check if every message in group was already seen, at least as a similar picture.
+           Remember group pictures, so reposts later in the same batch are caught too.
+        """
+        duplicate = any(msg.phash is not None for msg in msg_group)
+        for msg in msg_group:
+            seen = msg.phash is not None and self.seen_phash(msg.phash)
+            if msg.phash is not None and not seen:
+                self.pending_phashes.append(msg.phash)
+            if not seen and msg.sha256 not in posted:
+                duplicate = False
+        return duplicate
+
+    def commit_phashes(self) -> None:
+        """Index perceptual hashes of the committed batch"""
+        for value in self.pending_phashes:
+            self.phash_index.add(value)
+        self.pending_phashes.clear()
+
+
+class Destination:
+    """Channel posts are delivered to, with its own dedup history, filter and send queue"""
+
+    def __init__(self, route: Route, dedup: DedupState, outbox: Outbox,
+                 content_filter: ContentFilter) -> None:
+        self.route = route
+        self.name = route.name
+        self.dedup = dedup
+        self.outbox = outbox
+        self.content_filter = content_filter
+        self.logger = logging.getLogger('Main.destination')
+
+    def __repr__(self) -> str:
+        return f'<Destination object, name: {self.name!r}, channel: {self.route.channel}>'
+
+    def unposted(self, messages: list[list['MessageUpd']],
+                 posted: frozenset[bytes]) -> list[list['MessageUpd']]:
+        """Groups which have media not posted yet"""
+        fresh = []
+        for msg_group in messages:
+            # do not post messages if full group posted already
+            # if only some messages from the group exist - it may be new meme
+            if all(msg.sha256 in posted for msg in msg_group):
+                MESSAGES.inc(len(msg_group), outcome='deduped', destination=self.name)
+                continue
+            fresh.append(msg_group)
+        return fresh
+
+    def enqueue(self, messages: list[list['MessageUpd']], posted: frozenset[bytes],
+                db_session: Session,
+                source: Callable[[list['MessageUpd']], Optional[str]]) -> None:
+        """Put messages which are neither near duplicates nor rejected by filter to outbox,
+           source gives username of channel message group comes from
+        """
+        pending = []
+        candidates = []
+        # groups come oldest first
+        for msg_group in messages:
+            if self.dedup.is_near_duplicate(msg_group, posted):
+                self.logger.info('skip group %s, near duplicate already posted to %r',
+                                 msg_group, self.name)
+                MESSAGES.inc(len(msg_group), outcome='deduped', destination=self.name)
+                continue
+            text = ''
+            files = []
+            entities: set[str] = set()
+            for msg in msg_group[::-1]:
+                text = msg.text or text
+                entities.update(msg.entities)
+                files.append(msg.media)
+            candidates.append(Candidate(text, frozenset(entities), source(msg_group)))
+            pending.append((msg_group, files, text))
+        rejected_by = self.content_filter.check_batch(candidates)
+        for (msg_group, files, text), rule in zip(pending, rejected_by):
+            if rule is not None:
+                # do not post this message, but save it to db to filter it out on the previous step.
+                MESSAGES.inc(len(msg_group), outcome='filtered', destination=self.name)
+                continue
+            self.outbox.enqueue(db_session, files, text, msg_group[0].channel_id,
+                                [msg.msg_id for msg in msg_group[::-1]])
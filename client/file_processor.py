@@ -1,28 +1,86 @@
 """File related utilities"""
+import asyncio
 import logging
-from typing import Generator
+import os
+from typing import Callable, Generator, NamedTuple, Optional
+
+
+class ChannelDiff(NamedTuple):
+    """Channels added to and removed from channel file since it was parsed previous time"""
+
+    added: list[str]
+    removed: list[str]
 
 
 class FileProcessor:
-    """Process file with channel info"""
+    """Process file with channel info.
+       Parsed channels are kept in memory, file is parsed again only when its mtime or size change.
+    """
 
-    # pylint: disable=too-few-public-methods
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, accept: Optional[Callable[[str], bool]] = None) -> None:
         self.file = file
+        # only channels accepted by this predicate are kept, e.g. ones of current shard
+        self.accept = accept
         self.logger = logging.getLogger('Main.file_processor')
+        # channels of the last parsed file version, in file order
+        self.channels: list[str] = []
+        # (mtime, size) of the parsed file version, None if file was missing
+        self._stat: Optional[tuple[int, int]] = None
+        self._loaded = False
+
+    def _file_stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @property
+    def changed(self) -> bool:
+        """Whether file changed since it was parsed"""
+        return not self._loaded or self._file_stat() != self._stat
+
+    def refresh(self) -> Optional[ChannelDiff]:
+        """Parse file again if it changed, return channels added and removed since
+           the previous parse, None if file did not change
+        """
+        # stat before reading, so a write during parsing is noticed next time
+        stat = self._file_stat()
+        if self._loaded and stat == self._stat:
+            return None
+        channels = list(dict.fromkeys(self._parse()))
+        previous = set(self.channels)
+        current = set(channels)
+        diff = ChannelDiff([channel for channel in channels if channel not in previous],
+                           [channel for channel in self.channels if channel not in current])
+        self.channels = channels
+        self._stat = stat
+        self._loaded = True
+        self.logger.info('channel file parsed: %s channels, %s added, %s removed',
+                         len(channels), len(diff.added), len(diff.removed))
+        self.logger.debug('added channels: %s, removed channels: %s', diff.added, diff.removed)
+        return diff
 
-    def channel_generator(self) -> Generator[str, None, None]:
+    async def wait_changed(self, interval: float) -> None:
+        """Return once file differs from the parsed version, its mtime is checked every interval"""
+        while not self.changed:
+            await asyncio.sleep(interval)
+
+    def _parse(self) -> Generator[str, None, None]:
         """Parse channel file, yields channel usernames line by line"""
         try:
             with open(self.file, encoding='utf-8') as channels:
                 for channel in channels:
                     channel = channel.strip()
-                    self.logger.info('channel parsed: %s', channel)
-                    if channel.startswith('#'):
+                    self.logger.debug('channel parsed: %s', channel)
+                    if not channel or channel.startswith('#'):
                         self.logger.debug('skip current channel')
                         continue
+                    if self.accept is not None and not self.accept(channel):
+                        self.logger.debug('skip channel of another shard')
+                        continue
                     yield channel
         except FileNotFoundError:
             # we do not want to shutdown bot if nothing found
-            # file may be created on next call to this function or we already read what we need.
+            # file may be created later, it is parsed once it appears.
             self.logger.error('File %s not found, create file or check path', self.file)
@@ -0,0 +1,81 @@
+"""In-memory prefilter for message hashes, lets us skip database for never seen content"""
+
+import math
+from dataclasses import dataclass
+
+
+@dataclass
+class HashFilterStats:
+    """Counters to see how well the filter works"""
+
+    # hashes checked against the filter
+    lookups: int = 0
+    # filter said "never seen", database was not queried
+    negatives: int = 0
+    # filter said "maybe seen", but database did not have the hash
+    false_positives: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of lookups answered by the filter alone"""
+        return self.negatives / self.lookups if self.lookups else 0.
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Share of never seen hashes which still went to the database"""
+        unseen = self.negatives + self.false_positives
+        return self.false_positives / unseen if unseen else 0.
+
+    def __str__(self) -> str:
+        return f'lookups: {self.lookups}, hit rate: {self.hit_rate:.2%}, ' \
+               f'false positive rate: {self.false_positive_rate:.2%}'
+
+
+def dedup_key(digest: bytes) -> int:
+    """Compact fixed-width dedup key: first 8 bytes of digest as signed 64-bit integer,
+       which SQLite stores inline, instead of 32-byte blob
+    """
+    return int.from_bytes(digest[:8], 'little', signed=True)
+
+
+def dedup_key_bytes(key: int) -> bytes:
+    """Reverse of dedup_key, gives digest prefix which is enough for BloomFilter"""
+    return key.to_bytes(8, 'little', signed=True)
+
+
+class BloomFilter:
+    """Bloom filter over sha256 digests: no false negatives, false positives at error_rate.
+       Only first 8 bytes of digest are used, so compact dedup keys work the same as full digests.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hash_count = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, digest: bytes) -> list[int]:
+        # digest is already uniformly distributed, so use its parts for double hashing
+        # instead of hashing it again
+        h1 = int.from_bytes(digest[:4], 'little')
+        h2 = int.from_bytes(digest[4:8], 'little') | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hash_count)]
+
+    def add(self, digest: bytes) -> None:
+        """Remember digest"""
+        for pos in self._positions(digest):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self._count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def is_full(self) -> bool:
+        """False positive rate is higher than requested, filter should be rebuilt bigger"""
+        return self._count > self.capacity
@@ -0,0 +1,113 @@
+"""Logging pipeline: records are queued by the logging thread and written by a background one,
+noisy loggers are sampled and rate limited before they get to the queue
+"""
+
+import logging
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler
+from typing import Any, Callable, Optional
+
+from metrics import LOG_RECORDS_DROPPED
+
+
+class Lazy:
+    """Log argument computed only if record is written, e.g. Lazy(msg.stringify)"""
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func: Callable[..., Any], *args: Any) -> None:
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+
+def _rule(name: str, rules: dict[str, float]) -> Optional[str]:
+    """The most specific rule for logger name: its own or of the closest parent"""
+    while True:
+        if name in rules:
+            return name
+        if '.' not in name:
+            return None
+        name = name.rsplit('.', 1)[0]
+
+
+class ThrottleFilter(logging.Filter):
+    """Keeps random share of records of sampled loggers and at most N records per second
+       of rate limited ones. Rules apply to logger children too, the most specific rule wins.
+       Warnings and errors always pass.
+    """
+
+    def __init__(self, sampling: dict[str, float], rate_limits: dict[str, float]) -> None:
+        super().__init__()
+        # logger name -> share of records to keep
+        self.sampling = sampling
+        # logger name -> records per second, up to a second worth of them may come at once
+        self.rate_limits = rate_limits
+        # rule -> (tokens, when they were counted)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        # logger name -> (sampling rule, rate limit rule)
+        self._rules: dict[str, tuple[Optional[str], Optional[str]]] = {}
+        # records come from event loop and database threads
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rules = self._rules.get(record.name)
+        if rules is None:
+            rules = self._rules[record.name] = (_rule(record.name, self.sampling),
+                                                _rule(record.name, self.rate_limits))
+        sampling, rate_limit = rules
+        if sampling is not None and random.random() >= self.sampling[sampling]:
+            LOG_RECORDS_DROPPED.inc(reason='sampled')
+            return False
+        if rate_limit is not None and not self._take(rate_limit):
+            LOG_RECORDS_DROPPED.inc(reason='rate_limited')
+            return False
+        return True
+
+    def _take(self, rule: str) -> bool:
+        rate = self.rate_limits[rule]
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(rule, (rate, now))
+            tokens = min(tokens + (now - updated_at) * rate, rate)
+            allowed = tokens >= 1
+            self._buckets[rule] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+
+class AsyncQueueHandler(QueueHandler):
+    """Puts records to a bounded queue, QueueListener thread formats and writes them.
+       Records are not formatted here, so Lazy arguments are computed in the listener thread,
+       arguments should not be changed after they are logged.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # writer falls behind, losing records is better than blocking event loop
+            LOG_RECORDS_DROPPED.inc(reason='queue_full')
+
+
+class NameFilter(logging.Filter):
+    """Passes records of given loggers and their children"""
+
+    def __init__(self, names: tuple[str, ...]) -> None:
+        super().__init__()
+        self.names = names
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return any(record.name == name or record.name.startswith(f'{name}.')
+                   for name in self.names)
@@ -3,8 +3,22 @@
 import argparse
 import logging
 import os
+import queue
+from logging.handlers import QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
 from app import App
+from bot import BotSettings
+from database.database import SqliteSettings
+from destination import DedupSettings
+from log_pipeline import AsyncQueueHandler, NameFilter, ThrottleFilter
+from media_cache import MediaCacheSettings
+from outbox import OutboxSettings
+from retention import RetentionSettings
+from routing import Route, load_routes
+
+# per message trace is kept for a share of messages, telethon network trace is rate limited
+DEFAULT_LOG_SAMPLING = {'Main.bot.messages': 0.01}
+DEFAULT_LOG_RATE_LIMITS = {'telethon': 100.}
 
 
 def get_argparser() -> argparse.ArgumentParser:
@@ -14,18 +28,107 @@ def get_argparser() -> argparse.ArgumentParser:
     parser.add_argument('--api-hash', required=True, help='Your tg app hash')
     parser.add_argument('--channel-file', required=True, help='File with channels to get info from')
     parser.add_argument('--log-file', default='app.log', help='Log file')
-    parser.add_argument('--session-name', default='anon', help='Client session name')
-    parser.add_argument('--main-channel', required=True, help='Channel to post downloaded media')
+    parser.add_argument('--log-max-bytes', type=int, default=50 * 2 ** 20,
+                        help='Size of full debug log file to rotate it at')
+    parser.add_argument('--log-backups', type=int, default=7,
+                        help='How many rotated log files to keep, info log is rotated daily')
+    parser.add_argument('--log-sample', nargs='*', default=[], metavar='LOGGER=SHARE',
+                        help='Keep given share of debug and info records of logger and its '
+                             f'children, defaults: {DEFAULT_LOG_SAMPLING}')
+    parser.add_argument('--log-rate-limit', nargs='*', default=[], metavar='LOGGER=PER_SECOND',
+                        help='Keep at most given number of debug and info records per second, '
+                             f'defaults: {DEFAULT_LOG_RATE_LIMITS}')
+    parser.add_argument('--session-name', nargs='+', default=['anon'],
+                        help='Client session names, channels are split between several sessions')
+    parser.add_argument('--main-channel', help='Channel to post downloaded media from all channels')
+    parser.add_argument('--routes',
+                        help='Json file with destination channels and their source channels, '
+                             'see client/routing.py')
     parser.add_argument('--work-dir', default=os.path.join(os.path.curdir, 'app_work'),
                         help='Directory with bot artifacts')
+    parser.add_argument('--fetch-concurrency', type=int, default=BotSettings.fetch_concurrency,
+                        help='How many channels to fetch at the same time')
+    parser.add_argument('--fetch-timeout', type=float, default=BotSettings.fetch_timeout,
+                        help='Seconds to wait for the next message of one channel')
+    parser.add_argument('--fetch-buffer', type=int, default=BotSettings.fetch_buffer,
+                        help='How many message groups one channel fetch may get ahead of posting')
+    parser.add_argument('--poll-interval', type=float, default=BotSettings.poll_interval,
+                        help='Seconds between polls of channels with unknown post rate')
+    parser.add_argument('--channel-file-check-interval', type=float,
+                        default=BotSettings.channel_file_check_interval,
+                        help='Seconds between checks of channel file for changes')
+    parser.add_argument('--min-poll-interval', type=float, default=BotSettings.min_poll_interval,
+                        help='Seconds between polls of the busiest channels')
+    parser.add_argument('--max-poll-interval', type=float, default=BotSettings.max_poll_interval,
+                        help='Seconds between polls of channels which do not post')
+    parser.add_argument('--hash-filter-capacity', type=int,
+                        default=DedupSettings.hash_filter_capacity,
+                        help='Expected number of saved message hashes, used to size dedup filter')
+    parser.add_argument('--phash-threshold', type=int, default=DedupSettings.phash_threshold,
+                        help='Max different bits in thumbnails hashes to treat media as duplicate')
+    parser.add_argument('--sqlite-journal-mode', default=SqliteSettings.journal_mode,
+                        help='SQLite journal_mode pragma')
+    parser.add_argument('--sqlite-synchronous', default=SqliteSettings.synchronous,
+                        help='SQLite synchronous pragma')
+    parser.add_argument('--sqlite-cache-size', type=int, default=SqliteSettings.cache_size,
+                        help='SQLite cache_size pragma: pages if positive, KiB if negative')
+    parser.add_argument('--sqlite-mmap-size', type=int, default=SqliteSettings.mmap_size,
+                        help='SQLite mmap_size pragma in bytes')
+    parser.add_argument('--entity-ttl', type=float, default=BotSettings.entity_ttl,
+                        help='Seconds to use cached channel info before asking telegram again')
+    parser.add_argument('--retention-days', type=float, default=0,
+                        help='Forget saved messages older than this, so the database stays '
+                             'bounded; the same content may be posted again after that. '
+                             '0 keeps everything')
+    parser.add_argument('--retention-rows', type=int, default=RetentionSettings.max_rows,
+                        help='Keep at most this many saved messages, 0 is unlimited')
+    parser.add_argument('--compact-dedup-keys', action='store_true',
+                        help='Store 8-byte dedup keys instead of full hashes, '
+                             'existing hashes are converted on start. Converted keys are '
+                             'still used once this is switched off, but hashes are not restored')
+    parser.add_argument('--posts-per-minute', type=float,
+                        default=OutboxSettings.posts_per_minute,
+                        help='Average posting speed to the main channel')
+    parser.add_argument('--post-burst', type=int, default=OutboxSettings.burst,
+                        help='How many posts may be sent back to back')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on this localhost port, '
+                             'they are always written to metrics.prom in work dir')
+    parser.add_argument('--profile-cycles', type=int, default=0,
+                        help='Profile first N cycles, later N cycles are profiled on SIGUSR1')
+    parser.add_argument('--filter-config',
+                        help='Json file with content filter rules, see client/content_filter.py')
+    parser.add_argument('--media-cache-size', type=int, default=MediaCacheSettings.max_bytes,
+                        help='Bytes of downloaded media and thumbnails to keep in work dir')
+    parser.add_argument('--media-cache-age', type=float, default=MediaCacheSettings.max_age,
+                        help='Seconds to keep unused downloaded media')
+    parser.add_argument('--no-download-thumbs', dest='download_thumbs', action='store_false',
+                        help='Do not download thumbnails of media without inlined one, '
+                             'such media is then deduplicated by exact match only')
+    parser.add_argument('--live-updates', action='store_true',
+                        help='Receive new posts via telegram updates, '
+                             'polling is then used only to catch up missed messages')
     return parser
 
-def setup_logging(logger: logging.Logger, filepath: str) -> None:
-    """Setup logger handlers"""
+def parse_log_rules(values: list[str], defaults: dict[str, float]) -> dict[str, float]:
+    """Parse LOGGER=VALUE pairs on top of default rules"""
+    rules = dict(defaults)
+    for value in values:
+        name, sep, number = value.partition('=')
+        if not sep:
+            raise ValueError(f'Expected LOGGER=VALUE, got: {value}')
+        rules[name] = float(number)
+    return rules
+
+def setup_logging(filepath: str, max_bytes: int, backups: int,
+                  throttle: logging.Filter) -> QueueListener:
+    """Setup logger handlers: records are queued and written by listener thread,
+       which should be started and stopped by the caller
+    """
 
     # TODO: add handler to send error to user
-    fh = logging.FileHandler(filepath)
-    dbg_fh = logging.FileHandler(f'{filepath}.full')
+    fh = TimedRotatingFileHandler(filepath, when='midnight', backupCount=backups)
+    dbg_fh = RotatingFileHandler(f'{filepath}.full', maxBytes=max_bytes, backupCount=backups)
     sh = logging.StreamHandler()
 
     fh.setLevel(logging.INFO)
@@ -39,25 +142,63 @@ def setup_logging(logger: logging.Logger, filepath: str) -> None:
     dbg_fh.setFormatter(dbg_formatter)
     sh.setFormatter(formatter)
 
-    logging.basicConfig(level=logging.DEBUG, handlers=[fh, sh])
-
-    # set app logger
-    logger.addHandler(dbg_fh)
+    # full log has app and telethon records only
+    dbg_fh.addFilter(NameFilter(('Main', 'telethon')))
 
-    # set telethon logger
-    telethonlog = logging.getLogger('telethon')
-    telethonlog.addHandler(dbg_fh)
+    # event loop only puts records to the queue, files are written by listener thread
+    qh = AsyncQueueHandler(queue.Queue(10_000))
+    qh.addFilter(throttle)
+    logging.basicConfig(level=logging.DEBUG, handlers=[qh])
+    return QueueListener(qh.queue, fh, dbg_fh, sh, respect_handler_level=True)
 
 def main() -> None:
     """program entrypoint"""
     parser = get_argparser()
     args, unknown = parser.parse_known_args()
+    if args.main_channel is None and args.routes is None:
+        parser.error('one of --main-channel or --routes is required')
 
     logger = logging.getLogger('Main')
-    setup_logging(logger, os.path.join(args.work_dir, args.log_file))
+    throttle = ThrottleFilter(parse_log_rules(args.log_sample, DEFAULT_LOG_SAMPLING),
+                              parse_log_rules(args.log_rate_limit, DEFAULT_LOG_RATE_LIMITS))
+    listener = setup_logging(os.path.join(args.work_dir, args.log_file), args.log_max_bytes,
+                             args.log_backups, throttle)
+    listener.start()
     logger.info('Started with args: %s, also unknown args: %s', args, unknown)
-    App(args.api_id, args.api_hash, args.work_dir) \
-        .start(args.session_name, args.main_channel, args.channel_file)
+    settings = BotSettings(fetch_concurrency=args.fetch_concurrency,
+                           fetch_timeout=args.fetch_timeout,
+                           fetch_buffer=args.fetch_buffer,
+                           poll_interval=args.poll_interval,
+                           channel_file_check_interval=args.channel_file_check_interval,
+                           min_poll_interval=args.min_poll_interval,
+                           max_poll_interval=args.max_poll_interval,
+                           live_updates=args.live_updates,
+                           download_thumbs=args.download_thumbs,
+                           entity_ttl=args.entity_ttl,
+                           filter_config=args.filter_config,
+                           dedup=DedupSettings(hash_filter_capacity=args.hash_filter_capacity,
+                                               phash_threshold=args.phash_threshold,
+                                               compact_dedup_keys=args.compact_dedup_keys))
+    db_settings = SqliteSettings(journal_mode=args.sqlite_journal_mode,
+                                 synchronous=args.sqlite_synchronous,
+                                 cache_size=args.sqlite_cache_size,
+                                 mmap_size=args.sqlite_mmap_size)
+    routes = load_routes(args.routes) if args.routes is not None else []
+    if args.main_channel is not None:
+        # main channel keeps the history saved before routes were introduced
+        routes.insert(0, Route('', args.main_channel))
+    media_cache_settings = MediaCacheSettings(max_bytes=args.media_cache_size,
+                                              max_age=args.media_cache_age)
+    try:
+        App(args.api_id, args.api_hash, args.work_dir, args.metrics_port, args.profile_cycles,
+            media_cache_settings) \
+            .start(args.session_name, routes, args.channel_file, settings, db_settings,
+                   OutboxSettings(posts_per_minute=args.posts_per_minute, burst=args.post_burst),
+                   RetentionSettings(max_age=args.retention_days * 24 * 60 * 60,
+                                     max_rows=args.retention_rows))
+    finally:
+        # write out records still in the queue
+        listener.stop()
 
 if __name__ == '__main__':
     main()
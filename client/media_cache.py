@@ -0,0 +1,267 @@
+"""Content-addressed on-disk cache of downloaded media"""
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from hashlib import sha256
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from metrics import MEDIA_CACHE
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto, TypeMessageMedia
+
+# downloads into given path, returns None if there is nothing to download
+Fetch = Callable[[str], Awaitable[Any]]
+
+
+@dataclass
+class MediaCacheSettings:
+    """Disk budgets of the media cache"""
+
+    # total size of cached files, least recently used are evicted first
+    max_bytes: int = 1 << 30
+    # seconds since the last use after which file is evicted regardless of size
+    max_age: float = 7 * 86400
+    # seconds between checks for expired files, they are also evicted on every download
+    evict_interval: float = 60 * 60
+
+
+def media_key(media: Optional[TypeMessageMedia], thumb: bool = False) -> Optional[str]:
+    """Cache key of media file or of its smallest thumbnail, None if media has no file.
+       Key is made of file id, so the same file reposted by other channels has the same key.
+    """
+    if isinstance(media, MessageMediaPhoto) and media.photo is not None:
+        key = f'photo-{media.photo.id}'
+    elif isinstance(media, MessageMediaDocument) and media.document is not None:
+        key = f'document-{media.document.id}'
+    else:
+        return None
+    return f'{key}-thumb' if thumb else key
+
+
+class _Blob:
+    """File with some content, several keys may point to it"""
+
+    __slots__ = ('size', 'refs', 'pins')
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.refs = 0
+        # callers using the file right now, it is not evicted until they are done
+        self.pins = 0
+
+
+class MediaCache:
+    """Files are stored under sha256 of their content, so identical media is kept once,
+       and small ref files map cache keys to content digests.
+       Index of refs is kept in memory in LRU order, on start it is rebuilt from disk
+       with ref file mtime as the last use time.
+    """
+
+    def __init__(self, directory: str, settings: Optional[MediaCacheSettings] = None) -> None:
+        self.settings = settings or MediaCacheSettings()
+        self.logger = logging.getLogger('Main.media_cache')
+        self._blobs_dir = os.path.join(directory, 'blobs')
+        self._refs_dir = os.path.join(directory, 'refs')
+        self._tmp_dir = os.path.join(directory, 'tmp')
+        for path in (self._blobs_dir, self._refs_dir, self._tmp_dir):
+            os.makedirs(path, exist_ok=True)
+        # key -> (blob name: content digest and suffix, last use time), least recently used first
+        self._refs: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._blobs: dict[str, _Blob] = {}
+        self._size = 0
+        # downloads in progress, concurrent requests for the same key wait for them
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+    @property
+    def size(self) -> int:
+        """Total size of cached files in bytes"""
+        return self._size
+
+    def _blob_path(self, name: str) -> str:
+        return os.path.join(self._blobs_dir, name[:2], name)
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self._refs_dir, key)
+
+    def _load(self) -> None:
+        """Rebuild index from disk, drop leftovers of interrupted writes"""
+        for entry in os.scandir(self._tmp_dir):
+            os.unlink(entry.path)
+        refs = []
+        for entry in os.scandir(self._refs_dir):
+            with open(entry.path, encoding='ascii') as ref:
+                refs.append((entry.stat().st_mtime, entry.name, ref.read().strip()))
+        for used_at, key, name in sorted(refs):
+            if name not in self._blobs:
+                try:
+                    size = os.path.getsize(self._blob_path(name))
+                except OSError:
+                    os.unlink(self._ref_path(key))
+                    continue
+                self._blobs[name] = _Blob(size)
+                self._size += size
+            self._blobs[name].refs += 1
+            self._refs[key] = (name, used_at)
+        # blobs nobody points to, e.g. ref was evicted but blob removal was interrupted
+        for subdir in os.scandir(self._blobs_dir):
+            for entry in os.scandir(subdir.path):
+                if entry.name not in self._blobs:
+                    os.unlink(entry.path)
+        self.logger.info('media cache has %s files, %s bytes', len(self._refs), self._size)
+        self._evict(time.time())
+
+    def get(self, key: str) -> Optional[str]:
+        """Path to cached file, None if it is not cached"""
+        if key not in self._refs:
+            return None
+        name, _ = self._refs[key]
+        now = time.time()
+        self._refs[key] = (name, now)
+        self._refs.move_to_end(key)
+        # ref mtime keeps LRU order across restarts
+        os.utime(self._ref_path(key), (now, now))
+        return self._blob_path(name)
+
+    async def fetch(self, key: str, download: Fetch, suffix: str = '') -> Optional[str]:
+        """Path to cached file, download it first if it is not cached.
+           Concurrent calls with the same key share one download.
+           Suffix is kept in file name, telegram guesses media type by file extension.
+        """
+        path = self.get(key)
+        if path is not None:
+            MEDIA_CACHE.inc(outcome='hit')
+            return path
+        task = self._inflight.get(key)
+        if task is None:
+            MEDIA_CACHE.inc(outcome='miss')
+            # download runs as its own task, so it is not cancelled with the caller
+            # who happened to start it while others still wait for it
+            task = asyncio.ensure_future(self._download(key, download, suffix))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            MEDIA_CACHE.inc(outcome='coalesced')
+        return await asyncio.shield(task)
+
+    @asynccontextmanager
+    async def use(self, key: str, download: Fetch, suffix: str = '') \
+            -> AsyncIterator[Optional[str]]:
+        """Like fetch, but the file is not evicted until the block exits, e.g. while it is
+           uploaded
+        """
+        path = await self.fetch(key, download, suffix)
+        # other downloads may evict the file before the caller is resumed
+        while path is not None and key not in self._refs:
+            path = await self.fetch(key, download, suffix)
+        if path is None:
+            yield None
+            return
+        blob = self._blobs[self._refs[key][0]]
+        blob.pins += 1
+        try:
+            yield path
+        finally:
+            blob.pins -= 1
+
+    async def read(self, key: str, download: Fetch) -> Optional[bytes]:
+        """Content of cached file, download it first if it is not cached"""
+        async with self.use(key, download) as path:
+            if path is None:
+                return None
+            with open(path, 'rb') as file:
+                return file.read()
+
+    async def run(self) -> None:
+        """Eviction loop, never returns: files expire even if nothing is downloaded"""
+        while True:
+            await asyncio.sleep(self.settings.evict_interval)
+            self._evict(time.time())
+
+    async def _download(self, key: str, download: Fetch, suffix: str) -> Optional[str]:
+        fd, tmp_path = tempfile.mkstemp(suffix=suffix, dir=self._tmp_dir)
+        os.close(fd)
+        try:
+            if await download(tmp_path) is None:
+                return None
+            return await self._put(key, tmp_path, suffix)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    @staticmethod
+    def _digest(path: str) -> tuple[str, int]:
+        """Content digest and size of file"""
+        digest = sha256()
+        with open(path, 'rb') as file:
+            while chunk := file.read(1 << 20):
+                digest.update(chunk)
+        return digest.hexdigest(), os.path.getsize(path)
+
+    @staticmethod
+    def _move(tmp_path: str, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    async def _put(self, key: str, tmp_path: str, suffix: str) -> str:
+        """Move downloaded file into the cache under its content digest"""
+        loop = asyncio.get_running_loop()
+        # media files may be large, hash and move them off the event loop
+        digest, size = await loop.run_in_executor(None, self._digest, tmp_path)
+        name = digest + suffix
+        now = time.time()
+        self._evict(now, size)
+        path = self._blob_path(name)
+        if name not in self._blobs:
+            # the same content may be put under another key meanwhile, replacing identical
+            # file is harmless, but it is counted once
+            await loop.run_in_executor(None, self._move, tmp_path, path)
+            if name not in self._blobs:
+                self._blobs[name] = _Blob(size)
+                self._size += size
+        self._blobs[name].refs += 1
+        # write ref atomically too, so a crash never leaves a half written one
+        fd, ref_tmp = tempfile.mkstemp(dir=self._tmp_dir)
+        with os.fdopen(fd, 'w', encoding='ascii') as ref:
+            ref.write(name)
+        os.replace(ref_tmp, self._ref_path(key))
+        self._refs[key] = (name, now)
+        return path
+
+    def _evict(self, now: float, incoming: int = 0) -> None:
+        """Remove least recently used files until new one of incoming bytes fits the budgets,
+           files in use are skipped
+        """
+        expire_before = now - self.settings.max_age
+        size = self._size
+        victims = []
+        # refs of every blob to be removed, blob is freed once all of them are gone
+        removed: dict[str, int] = {}
+        for key, (name, used_at) in self._refs.items():
+            if size + incoming <= self.settings.max_bytes and used_at >= expire_before:
+                break
+            blob = self._blobs[name]
+            if blob.pins:
+                continue
+            victims.append(key)
+            removed[name] = removed.get(name, 0) + 1
+            if removed[name] == blob.refs:
+                size -= blob.size
+        for key in victims:
+            name, _ = self._refs.pop(key)
+            os.unlink(self._ref_path(key))
+            blob = self._blobs[name]
+            blob.refs -= 1
+            if not blob.refs:
+                del self._blobs[name]
+                self._size -= blob.size
+                os.unlink(self._blob_path(name))
+            MEDIA_CACHE.inc(outcome='evicted')
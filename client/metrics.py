@@ -0,0 +1,262 @@
+"""Counters and timing histograms of the bot, exported in Prometheus text format"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator, Optional, TypeVar
+
+from sqlalchemy import Engine, event
+
+T = TypeVar('T')
+
+LabelValues = tuple[str, ...]
+
+
+class _Metric:
+
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # values are updated from database and logging threads too
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, values: LabelValues, extra: str = '') -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterator[str]:
+        """Sample lines in text format"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Metric in text format, with HELP and TYPE header"""
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Value that only grows"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, description, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add amount to the counter with given labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Current value for given labels"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{self._format_labels(key)} {value}'
+
+
+class Gauge(Counter):
+    """Value that may go up and down"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set current value for given labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    kind = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # per labels: bucket counts (not cumulative), sum, count
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Add observed value"""
+        key = self._key(labels)
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket = i
+                break
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self.buckets) + 1), [0., 0.])
+            counts, totals = self._values[key]
+            counts[bucket] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe time spent in with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    async def time_iter(self, iterator: AsyncIterator[T], **labels: str) -> AsyncIterator[T]:
+        """Observe time spent waiting for each item of async iterator"""
+        while True:
+            start = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                self.observe(time.perf_counter() - start, **labels)
+            yield item
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, (total, count)) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = self._format_labels(key, f'le="{le}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_sum{self._format_labels(key)} {total}'
+            yield f'{self.name}_count{self._format_labels(key)} {int(count)}'
+
+
+class Registry:
+    """Set of metrics rendered together"""
+
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add metric to registry"""
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+        """Create and register counter"""
+        metric = Counter(name, description, labels)
+        self.register(metric)
+        return metric
+
+    def gauge(self, name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+        """Create and register gauge"""
+        metric = Gauge(name, description, labels)
+        self.register(metric)
+        return metric
+
+    def histogram(self, name: str, description: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        """Create and register histogram"""
+        metric = Histogram(name, description, labels, buckets)
+        self.register(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format"""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'bot_stage_seconds', 'Time spent in bot cycle stage', ('stage',))
+CYCLE_SECONDS = REGISTRY.histogram('bot_cycle_seconds', 'Time spent in whole polling cycle')
+MESSAGES = REGISTRY.counter(
+    'bot_messages_total',
+    'Messages by pipeline outcome: fetched, filtered, deduped, posted, failed',
+    ('outcome', 'destination'))
+FLOOD_WAIT_SECONDS = REGISTRY.counter(
+    'bot_flood_wait_seconds_total', 'Seconds telegram asked us to wait', ('source',))
+FILTER_HITS = REGISTRY.counter(
+    'bot_filter_hits_total', 'Message groups rejected by content filter rule', ('rule',))
+HASH_FILTER_RATE = REGISTRY.gauge(
+    'bot_hash_filter_rate', 'Dedup prefilter hit and false positive rates',
+    ('kind', 'destination'))
+MEDIA_CACHE = REGISTRY.counter(
+    'bot_media_cache_total', 'Media cache requests: hit, miss, coalesced, evicted', ('outcome',))
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    'bot_log_records_dropped_total', 'Log records dropped: sampled, rate_limited, queue_full',
+    ('reason',))
+RETENTION_DELETED = REGISTRY.counter(
+    'bot_retention_deleted_total', 'Rows deleted out of dedup window', ('table',))
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'bot_db_query_seconds', 'SQLite statements latency',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Observe latency of every statement executed by engine"""
+
+    # pylint: disable=unused-argument,too-many-arguments
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany) -> None:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - conn.info['query_start'].pop())
+
+
+class MetricsExporter:
+    """Write metrics to text file (for node_exporter textfile collector)
+       and optionally serve them over local HTTP
+    """
+
+    def __init__(self, path: str, port: Optional[int] = None,
+                 registry: Registry = REGISTRY) -> None:
+        self.path = path
+        self.port = port
+        self.registry = registry
+        self.logger = logging.getLogger('Main.metrics')
+
+    def write(self) -> None:
+        """Atomically replace metrics file with current values"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.registry.render())
+        os.replace(tmp_path, self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # any request gets metrics, we do not need routing here
+        await reader.readline()
+        body = self.registry.render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n' +
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self) -> None:
+        """Serve metrics on localhost:port if port is set"""
+        if self.port is None:
+            return
+        server = await asyncio.start_server(self._handle, '127.0.0.1', self.port)
+        self.logger.info('serving metrics on 127.0.0.1:%s', self.port)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,288 @@
+"""Persistent queue of posts waiting to be sent to destination channel"""
+
+import asyncio
+import logging
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional, Sequence
+
+import telethon
+from database.database import Database
+from database.database_mappings import Outbox as OutboxMapping
+from media_cache import MediaCache, media_key
+from metrics import FLOOD_WAIT_SECONDS, MESSAGES, STAGE_SECONDS
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from telethon.errors import (
+    ChatForwardsRestrictedError,
+    FileReferenceExpiredError,
+    FloodWaitError,
+    MediaEmptyError,
+    MediaInvalidError,
+    RPCError,
+)
+from telethon import utils
+from telethon.extensions import BinaryReader
+from telethon.tl.types import PeerChannel, TypeChat, TypeMessageMedia
+
+
+# how many latest destination messages are checked for posts interrupted by crash
+RECOVER_DEPTH = 50
+
+
+@dataclass
+class OutboxSettings:
+    """Sending limits for every destination channel"""
+
+    # average posting speed, telegram starts to answer with flood waits on faster posting
+    posts_per_minute: float = 20
+    # how many posts may be sent back to back after a pause
+    burst: int = 3
+    # attempts before the post is marked failed and left in the table for inspection
+    max_attempts: int = 5
+    # seconds to wait after the first failed attempt, doubled after each next one
+    retry_delay: float = 30
+
+
+class TokenBucket:
+    """Rate limiter: tokens are refilled at rate per second up to capacity,
+       every acquire takes one token or waits until it is refilled
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Take one token, wait if there are none"""
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """Do not give tokens for next seconds, e.g. after FloodWaitError"""
+        self._refill()
+        self._tokens = min(self._tokens, 0.) - seconds * self.rate
+
+
+def pack_media(media: list[TypeMessageMedia]) -> bytes:
+    """Serialize media with telegram TL serialization, objects are self-delimiting"""
+    return b''.join(bytes(item) for item in media)
+
+
+def unpack_media(data: bytes) -> list[TypeMessageMedia]:
+    """Reverse of pack_media"""
+    media = []
+    with BinaryReader(data) as reader:
+        while reader.tell_position() < len(data):
+            media.append(reader.tgread_object())
+    return media
+
+
+class Outbox:
+    """Approved posts are saved to outbox in the same transaction as messages they are made of,
+       sender task drains it with rate limit, so fetching never waits for posting
+       and approved posts survive restarts
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, client: telethon.TelegramClient, database: Database,
+                 settings: Optional[OutboxSettings] = None,
+                 media_cache: Optional[MediaCache] = None, destination: str = '') -> None:
+        self.client = client
+        self.db = database
+        # every destination has its own queue in the same table
+        self.destination = destination
+        self.settings = settings or OutboxSettings()
+        # media is re-uploaded from the cache when telegram refuses to send it by reference
+        self.media_cache = media_cache
+        self.logger = logging.getLogger('Main.outbox')
+        self.bucket = TokenBucket(self.settings.posts_per_minute / 60, self.settings.burst)
+        self._wakeup = asyncio.Event()
+
+    def enqueue(self, session: Session, media: list[TypeMessageMedia], caption: str,
+                channel_id: Optional[int] = None, msg_ids: Sequence[int] = ()) -> None:
+        """Add post to outbox, it is sent after the session is committed and wake() is called.
+           Media of messages msg_ids of channel_id is fetched again if its file reference expires.
+        """
+        self.db.insert(session, OutboxMapping(caption=caption, media=pack_media(media),
+                                              created_at=time.time(), next_attempt_at=0.,
+                                              destination=self.destination,
+                                              channel_id=channel_id,
+                                              msg_ids=','.join(map(str, msg_ids)) or None))
+
+    def wake(self) -> None:
+        """Tell sender there is something new in the outbox"""
+        self._wakeup.set()
+
+    def _next_post(self) -> tuple[Optional[OutboxMapping], Optional[float]]:
+        """Get the oldest post ready to be sent, or time when the next one will be ready"""
+        with self.db.get_session() as session:
+            query = self.db.select(OutboxMapping).filter(OutboxMapping.failed.is_(False),
+                                                         OutboxMapping.destination
+                                                         == self.destination) \
+                           .order_by(OutboxMapping.next_attempt_at, OutboxMapping.id) \
+                           .limit(1)
+            post = self.db.execute(session, query).scalars().first()
+            if post is None:
+                return None, None
+            session.expunge(post)
+        if post.next_attempt_at > time.time():
+            return None, post.next_attempt_at
+        return post, None
+
+    def _set_sending(self, post: OutboxMapping, sending_at: Optional[float]) -> None:
+        with self.db.get_session() as session, session.begin():
+            self.db.execute(session, update(OutboxMapping)
+                                     .where(OutboxMapping.id == post.id)
+                                     .values(sending_at=sending_at))
+
+    def _in_doubt(self) -> list[OutboxMapping]:
+        """Posts the previous run started to send, but did not see the result of"""
+        with self.db.get_session() as session:
+            query = self.db.select(OutboxMapping).filter(OutboxMapping.sending_at.is_not(None),
+                                                         OutboxMapping.destination
+                                                         == self.destination)
+            posts = list(self.db.execute(session, query).scalars())
+            session.expunge_all()
+        return posts
+
+    def _done(self, post: OutboxMapping) -> None:
+        with self.db.get_session() as session, session.begin():
+            session.delete(session.merge(post))
+
+    def _retry_later(self, post: OutboxMapping, err: Exception) -> None:
+        attempts = post.attempts + 1
+        failed = attempts >= self.settings.max_attempts
+        if failed:
+            self.logger.error('Give up sending post %s after %s attempts: %s',
+                              post.id, attempts, err)
+            MESSAGES.inc(len(unpack_media(post.media)), outcome='failed',
+                         destination=self.destination)
+        else:
+            self.logger.warning('Failed to send post %s, attempt %s: %s', post.id, attempts, err)
+        with self.db.get_session() as session, session.begin():
+            self.db.execute(session, update(OutboxMapping)
+                                     .where(OutboxMapping.id == post.id)
+                                     .values(attempts=attempts, failed=failed, error=str(err),
+                                             sending_at=None,
+                                             next_attempt_at=time.time() +
+                                             self.settings.retry_delay * 2 ** (attempts - 1)))
+
+    async def _refetch_media(self, post: OutboxMapping) -> Optional[list[TypeMessageMedia]]:
+        """Get media of post source messages with fresh file references,
+           None if it is not known or messages are deleted
+        """
+        if post.channel_id is None or not post.msg_ids:
+            return None
+        ids = [int(msg_id) for msg_id in post.msg_ids.split(',')]
+        msgs = await self.client.get_messages(PeerChannel(post.channel_id), ids=ids)
+        media = [msg.media for msg in msgs if msg is not None and msg.media is not None]
+        return media if len(media) == len(ids) else None
+
+    async def _send(self, destination: TypeChat, post: OutboxMapping,
+                    media: list[TypeMessageMedia]) -> None:
+        try:
+            await self._send_media(destination, media, post.caption)
+        except FileReferenceExpiredError:
+            # posts wait in the outbox for long enough to outlive file references
+            fresh = await self._refetch_media(post)
+            if fresh is None:
+                raise
+            self.logger.info('File reference of post %s expired, media fetched again', post.id)
+            await self._send_media(destination, fresh, post.caption)
+
+    async def _send_media(self, destination: TypeChat, media: list[TypeMessageMedia],
+                          caption: str) -> None:
+        try:
+            await self.client.send_file(destination, media, caption=caption)
+        except (ChatForwardsRestrictedError, MediaEmptyError, MediaInvalidError) as err:
+            if self.media_cache is None:
+                raise
+            self.logger.info('Can not send media by reference: %s, upload it', err)
+            # files stay in the cache until they are uploaded
+            async with AsyncExitStack() as stack:
+                files = []
+                for item in media:
+                    key = media_key(item)
+                    if key is None:
+                        raise
+                    # downloads are cached, so the next attempt does not download it again
+                    path = await stack.enter_async_context(self.media_cache.use(
+                        key, partial(self.client.download_media, item),
+                        utils.get_extension(item)))
+                    if path is None:
+                        raise
+                    files.append(path)
+                await self.client.send_file(destination, files, caption=caption)
+
+    async def _recover(self, destination: TypeChat) -> None:
+        """Resolve posts interrupted by crash: media sent by reference keeps its file id,
+           so a post is sent already if recent destination messages have all its media
+        """
+        posts = await self.db.run(self._in_doubt)
+        if not posts:
+            return
+        recent = set()
+        async for msg in self.client.iter_messages(destination, limit=RECOVER_DEPTH):
+            key = media_key(msg.media)
+            if key is not None:
+                recent.add(key)
+        for post in posts:
+            keys = [media_key(item) for item in unpack_media(post.media)]
+            # media without file can not be matched, such post is sent again
+            if keys and all(key is not None and key in recent for key in keys):
+                self.logger.info('post %s was sent before restart', post.id)
+                MESSAGES.inc(len(unpack_media(post.media)), outcome='posted',
+                             destination=self.destination)
+                await self.db.run(self._done, post)
+            else:
+                self.logger.info('post %s was not sent before restart, send it again', post.id)
+                await self.db.run(self._set_sending, post, None)
+
+    async def run(self, channel: str) -> None:
+        """Sender loop, never returns"""
+        # resolved with the sending client, access hashes differ between accounts
+        destination = await self.client.get_entity(await self.client.get_input_entity(channel))
+        self.logger.info('outbox sender started for destination %r', self.destination)
+        await self._recover(destination)
+        while True:
+            post, ready_at = await self.db.run(self._next_post)
+            if post is None:
+                self._wakeup.clear()
+                timeout = ready_at - time.time() if ready_at is not None else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.bucket.acquire()
+            media = unpack_media(post.media)
+            await self.db.run(self._set_sending, post, time.time())
+            try:
+                with STAGE_SECONDS.time(stage='send'):
+                    await self._send(destination, post, media)
+            except FloodWaitError as err:
+                self.logger.warning('Flood wait while posting, pause for %ss', err.seconds)
+                FLOOD_WAIT_SECONDS.inc(err.seconds, source='send')
+                self.bucket.pause(err.seconds)
+                continue
+            except (RPCError, TypeError, ValueError, OSError) as err:
+                # OSError covers connection errors and disk errors of media cache upload fallback
+                await self.db.run(self._retry_later, post, err)
+                continue
+            self.logger.debug('post %s sent', post.id)
+            MESSAGES.inc(len(media), outcome='posted', destination=self.destination)
+            await self.db.run(self._done, post)
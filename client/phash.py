@@ -0,0 +1,134 @@
+"""Perceptual hashes of media thumbnails and index to find near-duplicates among them"""
+
+import io
+from array import array
+from typing import Optional
+
+from PIL import Image
+from telethon import utils
+from telethon.tl.types import (
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    PhotoStrippedSize,
+    TypeMessageMedia,
+)
+
+HASH_BITS = 64
+_HASH_MASK = (1 << HASH_BITS) - 1
+# hashes of flat images (solid color, small text on plain background) have almost all bits
+# equal and match each other, bits set must be within [MIN_BITS, HASH_BITS - MIN_BITS]
+MIN_BITS = 8
+# Pillow < 9.1 has resampling filters on Image itself
+_LANCZOS = getattr(getattr(Image, 'Resampling', Image), 'LANCZOS')
+
+
+def dhash(image_data: bytes) -> int:
+    """64-bit difference hash: compares brightness of neighbour pixels of 9x8 grayscale image,
+       so it survives recompression, resizing and small color changes
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        pixels = list(image.convert('L').resize((9, 8), _LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return value
+
+
+def stripped_thumb(media: Optional[TypeMessageMedia]) -> Optional[bytes]:
+    """Get tiny jpg thumbnail, which telegram sends inlined with media, so no download needed"""
+    if isinstance(media, MessageMediaPhoto):
+        sizes = getattr(media.photo, 'sizes', None)
+    elif isinstance(media, MessageMediaDocument):
+        sizes = getattr(media.document, 'thumbs', None)
+    else:
+        sizes = None
+    for size in sizes or []:
+        if isinstance(size, PhotoStrippedSize):
+            return utils.stripped_photo_to_jpg(size.bytes)
+    return None
+
+
+def is_informative(value: int) -> bool:
+    """Whether hash has enough detail to tell different images apart"""
+    return MIN_BITS <= bin(value).count('1') <= HASH_BITS - MIN_BITS
+
+
+def image_phash(image_data: bytes) -> Optional[int]:
+    """Perceptual hash of image, None if it can not be decoded or has too little detail"""
+    try:
+        value = dhash(image_data)
+    except OSError:
+        # broken or unsupported image
+        return None
+    return value if is_informative(value) else None
+
+
+def media_phash(media: Optional[TypeMessageMedia]) -> Optional[int]:
+    """Perceptual hash of media thumbnail, None if media has no inlined thumbnail"""
+    thumb = stripped_thumb(media)
+    if thumb is None:
+        return None
+    return image_phash(thumb)
+
+
+def to_signed(value: int) -> int:
+    """SQLite stores signed 64-bit integers only"""
+    return value - (1 << HASH_BITS) if value >> (HASH_BITS - 1) else value
+
+
+def to_unsigned(value: int) -> int:
+    """Reverse of to_signed"""
+    return value & _HASH_MASK
+
+
+def hamming(lhs: int, rhs: int) -> int:
+    """Number of different bits"""
+    return bin(lhs ^ rhs).count('1')
+
+
+class PHashIndex:
+    """Multi-index hashing over 64-bit hashes.
+
+       Hash is split into threshold + 1 bands, so by pigeonhole principle two hashes within
+       threshold bits of each other are equal in at least one band. Each band maps its value to
+       bucket of full hashes, so lookup only checks hashes from threshold + 1 buckets
+       instead of whole history.
+    """
+
+    def __init__(self, threshold: int = 4) -> None:
+        self.threshold = threshold
+        bands = threshold + 1
+        widths = [HASH_BITS // bands + (i < HASH_BITS % bands) for i in range(bands)]
+        self._bands: list[tuple[int, int]] = []
+        shift = 0
+        for width in widths:
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._buckets: list[dict[int, array]] = [{} for _ in self._bands]
+        self._count = 0
+
+    def add(self, value: int) -> None:
+        """Add unsigned 64-bit hash to index"""
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            key = (value >> shift) & mask
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = array('Q', (value,))
+            else:
+                bucket.append(value)
+        self._count += 1
+
+    def find(self, value: int) -> Optional[int]:
+        """Find any stored hash within threshold bits from value"""
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            for candidate in buckets.get((value >> shift) & mask, ()):
+                if bin(value ^ candidate).count('1') <= self.threshold:
+                    return candidate
+        return None
+
+    def __contains__(self, value: int) -> bool:
+        return self.find(value) is not None
+
+    def __len__(self) -> int:
+        return self._count
@@ -0,0 +1,46 @@
+"""On-demand profiling of bot cycles"""
+
+import cProfile
+import logging
+import os
+import time
+from typing import Optional
+
+
+class CycleProfiler:
+    """Profile next N cycles after request() and dump stats to directory,
+       stats can be inspected with `python -m pstats file` or snakeviz
+    """
+
+    def __init__(self, directory: str, cycles: int = 1) -> None:
+        self.directory = directory
+        self.cycles = cycles
+        self.logger = logging.getLogger('Main.profiler')
+        self._requested = 0
+        self._left = 0
+        self._profile: Optional[cProfile.Profile] = None
+
+    def request(self, cycles: Optional[int] = None) -> None:
+        """Profile next cycles, e.g. from signal handler"""
+        self._requested = cycles or self.cycles
+        self.logger.info('profiling of next %s cycles requested', self._requested)
+
+    def cycle_started(self) -> None:
+        """Start profiling if requested"""
+        if self._profile is None and self._requested:
+            self._left, self._requested = self._requested, 0
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def cycle_finished(self) -> None:
+        """Dump profile once requested cycles are done"""
+        if self._profile is None:
+            return
+        self._left -= 1
+        if self._left > 0:
+            return
+        self._profile.disable()
+        path = os.path.join(self.directory, f'profile-{time.strftime("%Y%m%d-%H%M%S")}.prof')
+        self._profile.dump_stats(path)
+        self._profile = None
+        self.logger.info('profile saved to %s', path)
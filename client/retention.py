@@ -0,0 +1,236 @@
+"""Pruning of old dedup history and database compaction"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Optional, cast
+
+import destination
+from database.database import Database, chunked
+from database.database_mappings import DedupKey as DedupKeyMapping
+from database.database_mappings import Message as MessageMapping
+from hash_filter import dedup_key
+from metrics import RETENTION_DELETED
+from sqlalchemy import delete, func, text, tuple_, update
+from sqlalchemy.engine import CursorResult
+
+
+@dataclass
+class RetentionSettings:
+    """Dedup window: content older than it may be posted again"""
+
+    # seconds to keep saved messages, 0 keeps them forever
+    max_age: float = 0
+    # max number of saved messages, the oldest ones are deleted first, 0 is unlimited
+    max_rows: int = 0
+    # seconds between retention runs
+    interval: float = 60 * 60
+    # rows deleted in one transaction, bot waits for dedup lock while it is open
+    batch_size: int = 1000
+    # seconds to sleep between delete batches, so polling cycles get the lock in between
+    batch_pause: float = 0.1
+    # free pages given back to filesystem in one transaction
+    vacuum_pages: int = 1000
+    # seconds between ANALYZE runs
+    analyze_interval: float = 24 * 60 * 60
+
+
+class Retention:
+    """Deletes messages and dedup keys out of the dedup window in small batches,
+       then returns freed pages with incremental vacuum and refreshes query planner statistics.
+       Filters built from deleted rows are rebuilt once enough rows are gone.
+    """
+
+    def __init__(self, database: Database, dedups: list['destination.DedupState'],
+                 settings: Optional[RetentionSettings] = None) -> None:
+        self.db = database
+        # dedup states of all destinations, they share one lock
+        self.dedups = dedups
+        self.lock = dedups[0].lock
+        self.settings = settings or RetentionSettings()
+        self.logger = logging.getLogger('Main.retention')
+        # rows deleted since filters were built
+        self._stale = 0
+        self._analyzed_at = 0.
+
+    @property
+    def enabled(self) -> bool:
+        """Whether anything is ever deleted"""
+        return bool(self.settings.max_age or self.settings.max_rows)
+
+    def setup(self) -> None:
+        """Prepare database before bots start: convert storage to configured format"""
+        if self.dedups[0].settings.compact_dedup_keys:
+            self._compact_keys()
+        if not self.enabled:
+            return
+        with self.db.engine.connect() as connection:
+            if connection.execute(text('PRAGMA auto_vacuum')).scalar_one() == 2:
+                return
+            # database was created without incremental auto vacuum, it can only be switched on
+            # by full VACUUM, which can not run inside transaction
+            self.logger.info('convert database to incremental auto vacuum, it may take a while')
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            connection.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+            connection.execute(text('VACUUM'))
+
+    def _compact_keys(self) -> None:
+        """Move full hashes saved before compact dedup keys were enabled to dedup_keys.
+           Hashes can not be restored from keys, DedupState reads the keys in both modes
+        """
+        moved = 0
+        while True:
+            with self.db.get_session() as session, session.begin():
+                rows = self.db.execute(session, self.db.select(MessageMapping.id,
+                                                               MessageMapping.hash,
+                                                               MessageMapping.created_at,
+                                                               MessageMapping.destination)
+                                                       .filter(MessageMapping.hash.is_not(None))
+                                                       .limit(self.settings.batch_size * 10)) \
+                              .all()
+                if not rows:
+                    break
+                keys = {(row.destination, dedup_key(row.hash)): {
+                            'destination': row.destination, 'key': dedup_key(row.hash),
+                            'created_at': row.created_at or time.time()}
+                        for row in rows}
+                self.db.upsert(session, DedupKeyMapping, list(keys.values()),
+                               index_elements=['destination', 'key'],
+                               update=lambda excluded: {'created_at': func.max(
+                                   DedupKeyMapping.created_at, excluded.created_at)})
+                for chunk in chunked([row.id for row in rows]):
+                    self.db.execute(session, update(MessageMapping)
+                                             .where(MessageMapping.id.in_(chunk))
+                                             .values(hash=None))
+                moved += len(rows)
+        if moved:
+            self.logger.info('moved %s message hashes to compact dedup keys', moved)
+
+    async def run(self) -> None:
+        """Retention loop, never returns"""
+        while True:
+            if self.enabled:
+                deleted = await self.prune()
+                if deleted:
+                    await self._vacuum()
+            if time.time() - self._analyzed_at >= self.settings.analyze_interval:
+                await self._analyze()
+            await asyncio.sleep(self.settings.interval)
+
+    async def prune(self) -> int:
+        """Delete everything out of dedup window, return number of deleted rows"""
+        deleted = 0
+        for table, cutoff in (('messages', await self.db.run(self._messages_cutoff)),
+                              ('dedup_keys', await self.db.run(self._keys_cutoff))):
+            if cutoff is None:
+                continue
+            table_deleted = 0
+            while True:
+                async with self.lock:
+                    count = await self.db.run(self._delete_batch, table, cutoff)
+                RETENTION_DELETED.inc(count, table=table)
+                table_deleted += count
+                if count < self.settings.batch_size:
+                    break
+                await asyncio.sleep(self.settings.batch_pause)
+            self.logger.info('deleted %s rows from %s', table_deleted, table)
+            deleted += table_deleted
+        self._stale += deleted
+        filled = sum(len(dedup.hash_filter) for dedup in self.dedups)
+        if self._stale and self._stale * 4 >= max(filled, 1):
+            # filters can not forget single items, rebuild them without deleted rows
+            async with self.lock:
+                await self.db.run(self._rebuild_filters)
+            self._stale = 0
+        return deleted
+
+    def _rebuild_filters(self) -> None:
+        with self.db.get_session() as session:
+            for dedup in self.dedups:
+                dedup.warm_hash_filter(self.db, session)
+                dedup.warm_phash_index(self.db, session)
+
+    def _messages_cutoff(self) -> Optional[int]:
+        """Messages with id up to returned one are out of the window"""
+        cutoffs: list[Optional[int]] = []
+        with self.db.get_session() as session:
+            if self.settings.max_age:
+                cutoffs.append(self.db.execute(
+                    session, self.db.select(MessageMapping.id)
+                                    .filter(MessageMapping.created_at
+                                            < time.time() - self.settings.max_age)
+                                    .order_by(MessageMapping.id.desc()).limit(1)).scalar())
+            if self.settings.max_rows:
+                cutoffs.append(self.db.execute(
+                    session, self.db.select(MessageMapping.id)
+                                    .order_by(MessageMapping.id.desc())
+                                    .offset(self.settings.max_rows).limit(1)).scalar())
+        known = [cutoff for cutoff in cutoffs if cutoff is not None]
+        return max(known) if known else None
+
+    def _keys_cutoff(self) -> Optional[float]:
+        """Dedup keys last seen before returned time are out of the window"""
+        cutoffs: list[Optional[float]] = []
+        if self.settings.max_age:
+            cutoffs.append(time.time() - self.settings.max_age)
+        if self.settings.max_rows:
+            with self.db.get_session() as session:
+                cutoffs.append(self.db.execute(
+                    session, self.db.select(DedupKeyMapping.created_at)
+                                    .order_by(DedupKeyMapping.created_at.desc())
+                                    .offset(self.settings.max_rows).limit(1)).scalar())
+        known = [cutoff for cutoff in cutoffs if cutoff is not None]
+        return max(known) if known else None
+
+    def _delete_batch(self, table: str, cutoff: float) -> int:
+        if table == 'messages':
+            batch = self.db.select(MessageMapping.id).filter(MessageMapping.id <= cutoff)
+            query = delete(MessageMapping).where(MessageMapping.id.in_(
+                batch.order_by(MessageMapping.id).limit(self.settings.batch_size)))
+        else:
+            batch = self.db.select(DedupKeyMapping.destination, DedupKeyMapping.key) \
+                           .filter(DedupKeyMapping.created_at < cutoff)
+            query = delete(DedupKeyMapping).where(
+                tuple_(DedupKeyMapping.destination, DedupKeyMapping.key).in_(
+                    batch.limit(self.settings.batch_size)))
+        with self.db.get_session() as session, session.begin():
+            return cast(CursorResult, self.db.execute(session, query)).rowcount
+
+    async def _vacuum(self) -> None:
+        """Give free pages back to filesystem, a few at a time"""
+        freed = 0
+        while True:
+            async with self.lock:
+                pages = await self.db.run(self._vacuum_step)
+            if not pages:
+                break
+            freed += pages
+            await asyncio.sleep(self.settings.batch_pause)
+        self.logger.info('incremental vacuum freed %s pages', freed)
+
+    def _vacuum_step(self) -> int:
+        """Free at most vacuum_pages pages, return how many were freed"""
+        with self.db.engine.connect() as connection:
+            free = connection.execute(text('PRAGMA freelist_count')).scalar_one()
+            connection.rollback()
+            if free:
+                # sqlite3 module steps statements without result rows only once,
+                # and incremental_vacuum frees one page per step, executescript runs it fully
+                cast(sqlite3.Connection, connection.connection.driver_connection).executescript(
+                    f'PRAGMA incremental_vacuum({self.settings.vacuum_pages:d});')
+        return min(free, self.settings.vacuum_pages)
+
+    async def _analyze(self) -> None:
+        """Refresh statistics query planner uses to choose indexes"""
+        async with self.lock:
+            await self.db.run(self._update_statistics)
+        self._analyzed_at = time.time()
+        self.logger.info('database statistics updated')
+
+    def _update_statistics(self) -> None:
+        with self.db.engine.begin() as connection:
+            # approximate statistics, so ANALYZE takes bounded time on big tables
+            connection.execute(text('PRAGMA analysis_limit = 1000'))
+            connection.execute(text('ANALYZE'))
@@ -0,0 +1,52 @@
+"""Rules routing posts from source channels to destination channels
+
+Routes are loaded from json file:
+{
+    "destinations": [
+        {"name": "memes", "channel": "memes_channel", "sources": ["source1", "source2"]},
+        {"name": "long", "channel": "long_reads_channel", "filter": {"max_length": 1000}}
+    ]
+}
+Destination without "sources" gets posts from all channels. "filter" has the same format as
+content filter config, destinations without it use rules from --filter-config.
+Every destination has its own dedup history and send queue, name identifies them in database,
+so it should not change once something was posted.
+"""
+
+import json
+from dataclasses import dataclass
+from typing import Any, Optional
+
+
+@dataclass(frozen=True)
+class Route:
+    """Where posts of source channels go"""
+
+    name: str
+    # destination channel username or link
+    channel: str
+    # lowercase usernames of source channels, None routes all of them
+    sources: Optional[frozenset[str]] = None
+    # content filter rules, None uses the common ones
+    filter: Optional[dict[str, Any]] = None
+
+    def accepts(self, source: Optional[str]) -> bool:
+        """Whether posts of source channel go to this destination"""
+        return self.sources is None or (source or '').lower() in self.sources
+
+    @classmethod
+    def from_dict(cls, route: dict[str, Any]) -> 'Route':
+        sources = route.get('sources')
+        return cls(route['name'], route['channel'],
+                   frozenset(source.lower() for source in sources) if sources is not None else None,
+                   route.get('filter'))
+
+
+def load_routes(path: str) -> list[Route]:
+    """Load destinations from json file"""
+    with open(path, encoding='utf-8') as config:
+        routes = [Route.from_dict(route) for route in json.load(config)['destinations']]
+    names = [route.name for route in routes]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Destination names must be unique: {names}')
+    return routes
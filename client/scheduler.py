@@ -0,0 +1,117 @@
+"""Per-channel polling schedule adapted to how often channels post"""
+
+import heapq
+import math
+import random
+from typing import Iterable, Optional
+
+# poll channel about when one new post is expected there
+POSTS_PER_POLL = 1
+
+
+class ChannelSchedule:
+    """Polling state of one channel"""
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ('post_rate', 'polled_at', 'next_poll_at')
+
+    def __init__(self, post_rate: float, polled_at: Optional[float],
+                 next_poll_at: float) -> None:
+        # exponentially weighted average of posts per second
+        self.post_rate = post_rate
+        self.polled_at = polled_at
+        self.next_poll_at = next_poll_at
+
+    def __repr__(self) -> str:
+        return f'<ChannelSchedule object, post_rate: {self.post_rate}, ' \
+               f'polled_at: {self.polled_at}, next_poll_at: {self.next_poll_at}>'
+
+
+class PollScheduler:
+    """Priority queue of channels by next poll time.
+       Poll interval is inverse of channel post rate, bounded by min_interval and max_interval
+       and shifted by random jitter, so channels polled together once spread over time.
+    """
+
+    def __init__(self, interval: float, min_interval: float, max_interval: float,
+                 jitter: float = 0.1, rate_window: float = 6 * 60 * 60,
+                 slack: float = 5) -> None:
+        # interval for channels with unknown post rate
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        # seconds after which old observations weigh e times less
+        self.rate_window = rate_window
+        # channels due within slack seconds are polled together with already due ones
+        self.slack = slack
+        self.schedules: dict[int, ChannelSchedule] = {}
+        # (next_poll_at, channel id), entries outdated by reschedule are skipped when popped
+        self._heap: list[tuple[float, int]] = []
+
+    def __contains__(self, ch_id: int) -> bool:
+        return ch_id in self.schedules
+
+    def add(self, ch_id: int, post_rate: Optional[float] = None,
+            polled_at: Optional[float] = None, next_poll_at: Optional[float] = None) -> None:
+        """Start scheduling channel, never polled channels are due immediately"""
+        if post_rate is None:
+            post_rate = POSTS_PER_POLL / self.interval if self.interval else 0.
+        schedule = ChannelSchedule(post_rate, polled_at, next_poll_at or 0.)
+        self.schedules[ch_id] = schedule
+        heapq.heappush(self._heap, (schedule.next_poll_at, ch_id))
+
+    def due(self, now: float, channel_ids: Iterable[int]) -> set[int]:
+        """Channels from channel_ids which should be polled now"""
+        active = set(channel_ids)
+        due = set()
+        while self._heap and self._heap[0][0] <= now + self.slack:
+            next_poll_at, ch_id = heapq.heappop(self._heap)
+            schedule = self.schedules.get(ch_id)
+            if schedule is None or schedule.next_poll_at != next_poll_at:
+                continue
+            if ch_id in active:
+                due.add(ch_id)
+            else:
+                # channel was removed from channel file, forget it until it is back
+                del self.schedules[ch_id]
+        # keep due channels in queue until they are polled, in case the poll fails
+        for ch_id in due:
+            heapq.heappush(self._heap, (self.schedules[ch_id].next_poll_at, ch_id))
+        return due
+
+    def next_poll_at(self) -> Optional[float]:
+        """When the next channel is due, None if nothing is scheduled"""
+        while self._heap:
+            next_poll_at, ch_id = self._heap[0]
+            schedule = self.schedules.get(ch_id)
+            if schedule is not None and schedule.next_poll_at == next_poll_at:
+                return next_poll_at
+            heapq.heappop(self._heap)
+        return None
+
+    def polled(self, ch_id: int, posts: int, now: float) -> ChannelSchedule:
+        """Update channel post rate with the number of new posts found, schedule the next poll"""
+        schedule = self.schedules[ch_id]
+        if schedule.polled_at is not None and now > schedule.polled_at:
+            elapsed = now - schedule.polled_at
+            # weight of the new observation grows with time it covers,
+            # so rate does not depend on how often channel is polled
+            weight = 1 - math.exp(-elapsed / self.rate_window)
+            schedule.post_rate += weight * (posts / elapsed - schedule.post_rate)
+        schedule.polled_at = now
+        interval = POSTS_PER_POLL / schedule.post_rate if schedule.post_rate else math.inf
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        schedule.next_poll_at = now + min(max(interval, self.min_interval), self.max_interval)
+        heapq.heappush(self._heap, (schedule.next_poll_at, ch_id))
+        return schedule
+
+    def retry(self, ch_id: int, now: float) -> ChannelSchedule:
+        """Schedule channel whose poll failed again in min_interval, its post rate stays,
+           the next successful poll covers the time since the last successful one
+        """
+        schedule = self.schedules[ch_id]
+        schedule.next_poll_at = now + self.min_interval
+        heapq.heappush(self._heap, (schedule.next_poll_at, ch_id))
+        return schedule
@@ -0,0 +1,33 @@
+"""Split channels between several telegram accounts"""
+
+import bisect
+from hashlib import md5
+from typing import Callable
+
+
+class HashRing:
+    """Consistent hashing: every node owns many points on a ring, key belongs to the node
+       of the first point after the key hash. Adding a node moves only about 1/N of keys.
+    """
+
+    def __init__(self, nodes: list[str], replicas: int = 100) -> None:
+        if not nodes:
+            raise ValueError('HashRing needs at least one node')
+        self.nodes = list(nodes)
+        points = sorted((self._hash(f'{node}#{i}'), node)
+                        for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+    def node_for(self, key: str) -> str:
+        """Node which owns key"""
+        pos = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[pos]
+
+    def owned_by(self, node: str) -> Callable[[str], bool]:
+        """Predicate for channels of node, usernames are case insensitive"""
+        return lambda channel: self.node_for(channel.lower()) == node
@@ -0,0 +1,11 @@
+"""Modules are imported the same way main.py does, from client directory"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, os.path.join(ROOT, 'client'))
+
+# bot and app import each other, app has to be imported first
+import app  # noqa: E402,F401  # pylint: disable=wrong-import-position,unused-import
@@ -0,0 +1,32 @@
+import random
+
+from content_filter import AhoCorasick
+
+
+def naive_find(keywords: list[str], text: str) -> set[int]:
+    return {index for index, keyword in enumerate(keywords) if keyword in text}
+
+
+def test_overlapping_keywords():
+    keywords = ['he', 'she', 'his', 'hers']
+    automaton = AhoCorasick(keywords)
+    # 'she' and 'he' end at the same char, 'hers' starts inside 'she' via fail link
+    assert automaton.find('ushers') == {0, 1, 3}
+    assert automaton.find('ahishe') == {0, 1, 2}
+    assert automaton.find('hxs') == set()
+
+
+def test_keyword_inside_another():
+    automaton = AhoCorasick(['abcd', 'bc', 'c'])
+    assert automaton.find('xabcx') == {1, 2}
+    assert automaton.find('abcd') == {0, 1, 2}
+
+
+def test_matches_naive_search():
+    rnd = random.Random(1)
+    keywords = [''.join(rnd.choice('ab#') for _ in range(rnd.randint(1, 4)))
+                for _ in range(30)]
+    automaton = AhoCorasick(keywords)
+    for _ in range(200):
+        text = ''.join(rnd.choice('ab#c') for _ in range(rnd.randint(0, 30)))
+        assert automaton.find(text) == naive_find(keywords, text), text
@@ -0,0 +1,38 @@
+from hashlib import sha256
+
+from hash_filter import BloomFilter, dedup_key, dedup_key_bytes
+
+
+def digest(i: int) -> bytes:
+    return sha256(i.to_bytes(8, 'little')).digest()
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(digest(i))
+    assert all(digest(i) in bloom for i in range(1000))
+    assert len(bloom) == 1000
+    assert not bloom.is_full
+
+
+def test_false_positive_rate():
+    bloom = BloomFilter(10_000, 0.01)
+    for i in range(10_000):
+        bloom.add(digest(i))
+    false_positives = sum(digest(i) in bloom for i in range(10_000, 60_000))
+    assert false_positives / 50_000 < 0.02
+
+
+def test_is_full_over_capacity():
+    bloom = BloomFilter(10)
+    for i in range(11):
+        bloom.add(digest(i))
+    assert bloom.is_full
+
+
+def test_compact_key_matches_digest():
+    bloom = BloomFilter(100)
+    bloom.add(dedup_key_bytes(dedup_key(digest(1))))
+    assert digest(1) in bloom
+    assert digest(2) not in bloom
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import time
+
+from media_cache import MediaCache, MediaCacheSettings
+
+
+def writer(content: bytes):
+    async def download(path: str) -> str:
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+    return download
+
+
+def test_least_recently_used_evicted_over_budget(tmp_path):
+    cache = MediaCache(str(tmp_path), MediaCacheSettings(max_bytes=25))
+
+    async def fill() -> None:
+        await cache.fetch('a', writer(b'a' * 10))
+        await cache.fetch('b', writer(b'b' * 10))
+        # a is used again, so b is the least recently used one
+        assert cache.get('a') is not None
+        await cache.fetch('c', writer(b'c' * 10))
+
+    asyncio.run(fill())
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.size == 20
+    assert len(os.listdir(tmp_path / 'refs')) == 2
+
+
+def test_identical_content_kept_once(tmp_path):
+    cache = MediaCache(str(tmp_path), MediaCacheSettings(max_bytes=25))
+
+    async def fill() -> None:
+        await cache.fetch('a', writer(b'x' * 10))
+        await cache.fetch('repost', writer(b'x' * 10))
+        await cache.fetch('b', writer(b'b' * 10))
+
+    asyncio.run(fill())
+    assert len(cache) == 3
+    assert cache.size == 20
+
+
+def test_file_in_use_is_not_evicted(tmp_path):
+    cache = MediaCache(str(tmp_path), MediaCacheSettings(max_bytes=25))
+
+    async def use() -> None:
+        async with cache.use('a', writer(b'a' * 10)) as path:
+            await cache.fetch('b', writer(b'b' * 10))
+            await cache.fetch('c', writer(b'c' * 10))
+            assert os.path.exists(path)
+            assert cache.get('b') is None
+        await cache.fetch('d', writer(b'd' * 10))
+        assert cache.get('a') is None
+
+    asyncio.run(use())
+
+
+def test_expired_files_evicted_periodically(tmp_path):
+    cache = MediaCache(str(tmp_path), MediaCacheSettings(max_age=60, evict_interval=0.01))
+
+    async def expire() -> None:
+        await cache.fetch('a', writer(b'a'))
+        # last used long ago
+        # pylint: disable-next=protected-access
+        cache._refs['a'] = (cache._refs['a'][0], time.time() - 120)
+        task = asyncio.ensure_future(cache.run())
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(expire())
+    assert len(cache) == 0 and cache.size == 0
+    assert os.listdir(tmp_path / 'refs') == []
+
+
+def test_index_rebuilt_on_restart(tmp_path):
+    cache = MediaCache(str(tmp_path), MediaCacheSettings(max_bytes=25))
+
+    async def fill() -> None:
+        await cache.fetch('a', writer(b'a' * 10))
+        await cache.fetch('b', writer(b'b' * 10))
+
+    asyncio.run(fill())
+    old = time.time() - 100
+    os.utime(tmp_path / 'refs' / 'b', (old, old))
+    # a budget lowered between runs evicts the least recently used file on start
+    restarted = MediaCache(str(tmp_path), MediaCacheSettings(max_bytes=15))
+    assert restarted.get('b') is None
+    assert restarted.get('a') is not None
+    assert restarted.size == 10
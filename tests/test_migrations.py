@@ -0,0 +1,81 @@
+import sqlite3
+
+from database.database import Database
+from database.database_mappings import Channel as ChannelMapping
+from database.migrations import MIGRATIONS
+
+# schema created by the first release, before any migration
+BASELINE_SCHEMA = '''
+CREATE TABLE channels (
+    id INTEGER NOT NULL,
+    username VARCHAR NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (username)
+);
+CREATE TABLE messages (
+    id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    hash BLOB,
+    PRIMARY KEY (id),
+    FOREIGN KEY(channel_id) REFERENCES channels (id)
+);
+INSERT INTO channels VALUES (1, 'first'), (2, 'second');
+INSERT INTO messages (msg_id, channel_id, hash)
+    VALUES (10, 1, x'01'), (12, 1, x'02'), (5, 2, x'03');
+'''
+
+
+def baseline_db(path: str) -> None:
+    connection = sqlite3.connect(path)
+    connection.executescript(BASELINE_SCHEMA)
+    connection.close()
+
+
+def query(path: str, sql: str) -> list[tuple]:
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(sql).fetchall()
+    finally:
+        connection.close()
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    baseline_db(path)
+    Database(path).close()
+    assert query(path, 'PRAGMA user_version') == [(len(MIGRATIONS),)]
+    assert query(path, 'SELECT channel_id, last_msg_id FROM channel_state ORDER BY channel_id') \
+        == [(1, 12), (2, 5)]
+    assert query(path, 'SELECT msg_id, hash, destination FROM messages ORDER BY id') \
+        == [(10, b'\x01', ''), (12, b'\x02', ''), (5, b'\x03', '')]
+    assert query(path, 'SELECT count(*) FROM messages WHERE created_at IS NULL') == [(0,)]
+    assert query(path, 'SELECT username, channel_id FROM channel_usernames ORDER BY username') \
+        == [('first', 1), ('second', 2)]
+
+
+def test_renamed_channel_username_can_be_reused(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    baseline_db(path)
+    database = Database(path)
+    with database.get_session() as session, session.begin():
+        database.insert(session, ChannelMapping(id=3, username='first'))
+    database.close()
+    assert query(path, "SELECT id FROM channels WHERE username = 'first' ORDER BY id") \
+        == [(1,), (3,)]
+
+
+def test_migrations_run_once(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    baseline_db(path)
+    Database(path).close()
+    schema = query(path, 'SELECT sql FROM sqlite_master ORDER BY name')
+    Database(path).close()
+    assert query(path, 'SELECT sql FROM sqlite_master ORDER BY name') == schema
+    assert query(path, 'SELECT count(*) FROM channel_state') == [(2,)]
+
+
+def test_new_database_needs_no_migrations(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    Database(path).close()
+    assert query(path, 'PRAGMA user_version') == [(len(MIGRATIONS),)]
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from typing import Callable
+
+from database.database import Database
+from database.database_mappings import Outbox as OutboxMapping
+from fake_client import FakeSettings, FakeTelegramClient
+from outbox import Outbox, OutboxSettings
+from sqlalchemy import update
+
+MAIN = 1000
+
+
+async def wait_for(condition: Callable[[], bool], timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition is not met in time'
+        await asyncio.sleep(0.01)
+
+
+def setup_outbox(tmp_path) -> tuple[FakeTelegramClient, Database, Outbox]:
+    client = FakeTelegramClient(1, FakeSettings(history=10, text_rate=0, album_rate=0))
+    database = Database(str(tmp_path / 'db.sqlite'))
+    outbox = Outbox(client, database, OutboxSettings(posts_per_minute=6000, burst=100))
+    return client, database, outbox
+
+
+def enqueue(database: Database, outbox: Outbox, ch_id: int, msg_id: int,
+            sending: bool = False) -> None:
+    media = outbox.client._message(ch_id, msg_id).media  # pylint: disable=protected-access
+    with database.get_session() as session, session.begin():
+        outbox.enqueue(session, [media], f'{ch_id}/{msg_id}', ch_id, [msg_id])
+    if sending:
+        with database.get_session() as session, session.begin():
+            session.execute(update(OutboxMapping)
+                            .where(OutboxMapping.caption == f'{ch_id}/{msg_id}')
+                            .values(sending_at=time.time()))
+
+
+def rows(database: Database) -> list[str]:
+    with database.get_session() as session:
+        return [post.caption for post in session.query(OutboxMapping)]
+
+
+async def run_outbox(outbox: Outbox, condition: Callable[[], bool]) -> None:
+    task = asyncio.ensure_future(outbox.run('main'))
+    try:
+        await wait_for(lambda: condition() or task.done())
+        if task.done():
+            task.result()
+    finally:
+        task.cancel()
+
+
+def test_sends_queued_posts(tmp_path):
+    client, database, outbox = setup_outbox(tmp_path)
+    enqueue(database, outbox, 1001, 1)
+    enqueue(database, outbox, 1001, 2)
+    asyncio.run(run_outbox(outbox, lambda: len(client.sent) == 2 and not rows(database)))
+    assert [caption for _, _, caption in client.sent] == ['1001/1', '1001/2']
+    assert rows(database) == []
+
+
+def test_recovery_does_not_send_twice(tmp_path):
+    client, database, outbox = setup_outbox(tmp_path)
+    # crashed after sending: destination channel already has this media
+    enqueue(database, outbox, MAIN, 10, sending=True)
+    # crashed before sending
+    enqueue(database, outbox, 1001, 3, sending=True)
+    enqueue(database, outbox, 1001, 4)
+    asyncio.run(run_outbox(outbox, lambda: len(client.sent) == 2 and not rows(database)))
+    assert [caption for _, _, caption in client.sent] == ['1001/3', '1001/4']
+    assert rows(database) == []
+
+
+def test_failed_post_is_kept(tmp_path):
+    client, database, outbox = setup_outbox(tmp_path)
+    outbox.settings.max_attempts = 2
+    outbox.settings.retry_delay = 0
+
+    async def send_file(*_args, **_kwargs):
+        raise ValueError('broken media')
+
+    client.send_file = send_file
+    enqueue(database, outbox, 1001, 1)
+
+    def failed() -> bool:
+        with database.get_session() as session:
+            return session.query(OutboxMapping).filter(OutboxMapping.failed.is_(True)).count() == 1
+
+    asyncio.run(run_outbox(outbox, failed))
+    with database.get_session() as session:
+        post = session.query(OutboxMapping).one()
+        assert (post.attempts, post.error, post.sending_at) == (2, 'broken media', None)
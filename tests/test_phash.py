@@ -0,0 +1,36 @@
+import random
+
+from phash import PHashIndex, hamming
+
+
+def flip(value: int, bits: list[int]) -> int:
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def test_finds_within_threshold():
+    index = PHashIndex(4)
+    value = 0x0123456789abcdef
+    index.add(value)
+    # spread over different bands and all in one band
+    assert flip(value, [0, 13, 26, 39]) in index
+    assert flip(value, [60, 61, 62, 63]) in index
+    assert flip(value, [0, 13, 26, 39, 52]) not in index
+    assert index.find(flip(value, [5])) == value
+    assert len(index) == 1
+
+
+def test_matches_brute_force():
+    rnd = random.Random(2)
+    stored = [rnd.getrandbits(64) for _ in range(500)]
+    index = PHashIndex(6)
+    for value in stored:
+        index.add(value)
+    queries = [flip(rnd.choice(stored), rnd.sample(range(64), rnd.randint(0, 9)))
+               for _ in range(500)]
+    for query in queries:
+        expected = any(hamming(query, value) <= 6 for value in stored)
+        found = index.find(query)
+        assert (found is not None) == expected
+        assert found is None or hamming(query, found) <= 6
@@ -0,0 +1,59 @@
+from scheduler import PollScheduler
+
+
+def scheduler() -> PollScheduler:
+    return PollScheduler(interval=300, min_interval=60, max_interval=3600, jitter=0,
+                         rate_window=3600, slack=0)
+
+
+def test_new_channels_due_immediately():
+    polls = scheduler()
+    polls.add(1)
+    polls.add(2, post_rate=0.01, polled_at=0, next_poll_at=500)
+    assert polls.due(100, [1, 2]) == {1}
+    assert polls.next_poll_at() == 0
+    assert polls.due(500, [1, 2]) == {1, 2}
+
+
+def test_interval_follows_post_rate():
+    polls = scheduler()
+    for ch_id in (1, 2, 3):
+        polls.add(ch_id, polled_at=0)
+    now = 0.
+    for _ in range(50):
+        now += 600
+        polls.polled(1, 100, now)
+        polls.polled(2, 0, now)
+        polls.polled(3, 2, now)
+    assert polls.schedules[1].next_poll_at == now + 60
+    assert polls.schedules[2].next_poll_at == now + 3600
+    assert 250 < polls.schedules[3].next_poll_at - now < 350
+
+
+def test_due_channel_stays_queued_until_polled():
+    polls = scheduler()
+    polls.add(1)
+    assert polls.due(0, [1]) == {1}
+    # poll failed, channel is still due
+    assert polls.due(10, [1]) == {1}
+    polls.polled(1, 0, 10)
+    assert polls.due(11, [1]) == set()
+
+
+def test_retry_keeps_rate():
+    polls = scheduler()
+    polls.add(1, post_rate=0.5, polled_at=0)
+    polls.due(0, [1])
+    schedule = polls.retry(1, 100)
+    assert (schedule.post_rate, schedule.polled_at, schedule.next_poll_at) == (0.5, 0, 160)
+    assert polls.due(100, [1]) == set()
+    assert polls.due(160, [1]) == {1}
+
+
+def test_removed_channel_is_forgotten():
+    polls = scheduler()
+    polls.add(1)
+    polls.add(2)
+    assert polls.due(0, [2]) == {2}
+    assert 1 not in polls
+    assert polls.next_poll_at() == 0